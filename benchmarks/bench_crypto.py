@@ -0,0 +1,90 @@
+"""Пропускная способность шифрования: старый AES-CBC (+HMAC) против конверта AES-GCM"""
+import argparse
+import hmac
+import os
+import sys
+import time
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.backends import default_backend
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.protocols import encrypt_message, decrypt_message
+
+SIZES = [100, 4096, 1024 * 1024]
+
+
+def encrypt_cbc(key, message):
+    iv = os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    padded_data = padder.update(message) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).encryptor()
+    return iv + encryptor.update(padded_data) + encryptor.finalize()
+
+
+def encrypt_cbc_hmac(key, message):
+    # Прежний формат shared/protocols.py: второй проход HMAC-SHA256 по шифротексту
+    ciphertext = encrypt_cbc(key, message)
+    return ciphertext + hmac.new(key, ciphertext, 'sha256').digest()
+
+
+def decrypt_cbc_hmac(key, encrypted_data):
+    ciphertext, tag = encrypted_data[:-32], encrypted_data[-32:]
+    if not hmac.compare_digest(tag, hmac.new(key, ciphertext, 'sha256').digest()):
+        raise ValueError("HMAC verification failed")
+    return decrypt_message(key, ciphertext)
+
+
+def encrypt_chacha(key, message):
+    nonce = os.urandom(12)
+    return nonce + ChaCha20Poly1305(key).encrypt(nonce, message, None)
+
+
+def decrypt_chacha(key, encrypted_data):
+    return ChaCha20Poly1305(key).decrypt(encrypted_data[:12], encrypted_data[12:], None)
+
+
+SCHEMES = {
+    'aes-cbc': (encrypt_cbc, decrypt_message),
+    'aes-cbc+hmac': (encrypt_cbc_hmac, decrypt_cbc_hmac),
+    'aes-gcm (v1)': (encrypt_message, decrypt_message),
+    'chacha20-poly1305': (encrypt_chacha, decrypt_chacha),
+}
+
+
+def throughput(func, key, data, min_time):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func(key, data)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls * len(data) / elapsed / 2 ** 20, elapsed / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Размеры сообщений, байт')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Время замера на точку, сек')
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    for size in args.sizes:
+        message = os.urandom(size)
+        print(f"\nmessage {size} B")
+        print(f"{'scheme':18} {'overhead':>9} {'enc MB/s':>9} {'enc us':>9} {'dec MB/s':>9} {'dec us':>9}")
+        for name, (encrypt, decrypt) in SCHEMES.items():
+            encrypted = encrypt(key, message)
+            assert decrypt(key, encrypted) == message
+            enc_mbs, enc_us = throughput(encrypt, key, message, args.min_time)
+            dec_mbs, dec_us = throughput(decrypt, key, encrypted, args.min_time)
+            print(f"{name:18} {len(encrypted) - size:>9} {enc_mbs:>9.1f} {enc_us:>9.2f} "
+                  f"{dec_mbs:>9.1f} {dec_us:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""Нагрузочный тест сервера: N виртуальных клиентов, пропускная способность и задержка доставки"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from aiohttp import ClientSession, ClientError
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+ROOT = Path(__file__).resolve().parent.parent
+SERVER = ROOT / 'server' / 'server.py'
+# Модули клиента импортируются так же, как их видит client.py
+sys.path[:0] = [str(ROOT / 'client'), str(ROOT)]
+
+from client import send_text, read_messages, ack_messages
+from crypto import CryptoManager
+from key_manager import get_user_id
+from shared.crypto_utils import deserialize_public_key
+from shared.protocols import MessageProtocol, BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE
+
+PORT = 8099
+STARTUP_TIMEOUT = 15  # Сколько ждать запуска сервера, сек
+SAMPLE_INTERVAL = 0.2  # Период замера RSS сервера, сек
+LONG_POLL_WAIT = 5
+
+
+def rss_kb(pid):
+    # RSS процесса и его воркеров (--workers) по /proc; вне Linux - None
+    try:
+        children = Path(f'/proc/{pid}/task/{pid}/children').read_text().split()
+        total = 0
+        for p in [pid] + [int(c) for c in children]:
+            for line in Path(f'/proc/{p}/status').read_text().splitlines():
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1])
+        return total
+    except (OSError, ValueError):
+        return None
+
+
+def db_size(directory):
+    # Всё хранилище: база SQLite с шардами и WAL или сегменты журнала (без переданных файлов)
+    return sum(p.stat().st_size for p in Path(directory).rglob('*') if p.is_file() and 'files' not in p.parts)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': max(values, default=None)}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98], 'max': max(values)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_for_server(base_url, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    async with ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'Сервер завершился с кодом {process.returncode}')
+            try:
+                async with session.get(f'{base_url}/public_key') as resp:
+                    if resp.status == 200:
+                        return
+            except ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError('Сервер не запустился')
+
+
+class VirtualClient:
+    """Один участник диалога: регистрация, отправка и приём через код настоящего клиента"""
+
+    def __init__(self, index, binary):
+        self.username = f'bench{index}'
+        self.user_id = get_user_id(self.username)
+        self.crypto = CryptoManager(ec.generate_private_key(ec.SECP384R1()))
+        self.binary = binary
+        self.session = None
+        self.peer = None
+        self.peer_public_key = None
+        self.latencies = []
+        self.errors = 0
+
+    async def register(self, base_url):
+        self.session = ClientSession()
+        public_key = self.crypto.public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        if self.binary:
+            request = {
+                'data': MessageProtocol.encode_register_binary(self.user_id, public_key, self.username),
+                'headers': {'Content-Type': BINARY_CONTENT_TYPE}
+            }
+        else:
+            request = {'data': MessageProtocol.encode_register(self.user_id, public_key.decode(), self.username)}
+        async with self.session.post(f'{base_url}/register', **request) as resp:
+            resp.raise_for_status()
+
+    async def connect(self, base_url, peer):
+        self.peer = peer
+        async with self.session.get(f'{base_url}/user_public_key?user_id={peer.user_id.hex()}') as resp:
+            resp.raise_for_status()
+            self.peer_public_key = deserialize_public_key((await resp.text()).encode())
+        await self.crypto.derive_shared_key_async(self.peer_public_key)
+
+    async def send(self, base_url, count, size, rate):
+        interval = 1 / rate if rate else 0
+        start = time.monotonic()
+        for seq in range(count):
+            if interval:
+                await asyncio.sleep(max(0, start + seq * interval - time.monotonic()))
+            # Время отправки едет внутри зашифрованного текста: задержка меряется от и до клиента
+            text = f'{time.time():.6f} '.ljust(size, 'x')
+            try:
+                await send_text(self.session, base_url, self.user_id, self.crypto, self.peer.user_id,
+                                self.peer_public_key, self.binary, text)
+            except ClientError:
+                self.errors += 1
+
+    async def receive(self, base_url, count):
+        headers = {'Accept': BINARY_CONTENT_TYPE if self.binary else JSON_CONTENT_TYPE}
+        last_id = 0
+        while len(self.latencies) < count:
+            url = f'{base_url}/messages?user_id={self.user_id.hex()}&last_id={last_id}&wait={LONG_POLL_WAIT}'
+            try:
+                async with self.session.get(url, headers=headers) as resp:
+                    messages = await read_messages(resp)
+            except ClientError:
+                self.errors += 1
+                continue
+            if not messages:
+                continue
+            decrypted = await self.crypto.decrypt_many(
+                self.peer_public_key, [(msg['encrypted_message'], msg.get('blob')) for msg in messages]
+            )
+            now = time.time()
+            for text in decrypted:
+                if text is None:
+                    self.errors += 1
+                    continue
+                self.latencies.append(now - float(text.split(b' ', 1)[0]))
+            last_id = messages[-1]['id']
+            await ack_messages(self.session, base_url, self.user_id, self.crypto, last_id)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+async def sample_rss(pid, samples):
+    while True:
+        rss = rss_kb(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def run(args, base_url, process, data_dir):
+    clients = [VirtualClient(i, not args.json) for i in range(args.clients)]
+    try:
+        # Подготовка (регистрация и вывод ключей PBKDF2) в замер не входит
+        await asyncio.gather(*(client.register(base_url) for client in clients))
+        await asyncio.gather(*(
+            client.connect(base_url, clients[i ^ 1]) for i, client in enumerate(clients)
+        ))
+
+        rss = []
+        sampler = asyncio.create_task(sample_rss(process.pid, rss))
+        db_start = db_size(data_dir)
+        start = time.perf_counter()
+        receivers = [asyncio.create_task(client.receive(base_url, args.messages)) for client in clients]
+        await asyncio.gather(*(client.send(base_url, args.messages, args.size, args.rate) for client in clients))
+        sent = time.perf_counter() - start
+        try:
+            await asyncio.wait_for(asyncio.gather(*receivers), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        duration = time.perf_counter() - start
+        sampler.cancel()
+        db_end = db_size(data_dir)
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+
+    latencies = [latency * 1000 for client in clients for latency in client.latencies]
+    delivered = len(latencies)
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {
+            'clients': args.clients,
+            'messages': args.messages,
+            'size': args.size,
+            'rate': args.rate,
+            'format': 'json' if args.json else 'binary',
+            'server_args': args.server_args,
+        },
+        'sent': args.clients * args.messages,
+        'delivered': delivered,
+        'errors': sum(client.errors for client in clients),
+        'duration_s': duration,
+        'send_msgs_per_sec': args.clients * args.messages / sent,
+        'msgs_per_sec': delivered / duration,
+        'latency_ms': dict(percentiles(latencies), mean=statistics.fmean(latencies) if latencies else None),
+        'server_rss_kb': {
+            'start': rss[0] if rss else None,
+            'peak': max(rss, default=None),
+            'end': rss[-1] if rss else None,
+        },
+        'db_bytes': {'start': db_start, 'end': db_end, 'growth': db_end - db_start},
+    }
+
+
+def print_report(result):
+    latency = result['latency_ms']
+    rss = result['server_rss_kb']
+    db = result['db_bytes']
+    print(f"delivered     {result['delivered']}/{result['sent']} (errors: {result['errors']})")
+    print(f"duration      {result['duration_s']:.2f} s")
+    print(f"throughput    {result['msgs_per_sec']:.0f} msg/s (send {result['send_msgs_per_sec']:.0f} msg/s)")
+    if latency['p50'] is not None:
+        print(f"latency ms    p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+              f"p99 {latency['p99']:.1f}  max {latency['max']:.1f}")
+    if rss['peak'] is not None:
+        print(f"server RSS    {rss['start'] / 1024:.1f} -> {rss['end'] / 1024:.1f} MB "
+              f"(peak {rss['peak'] / 1024:.1f} MB)")
+    print(f"db size       {db['start'] / 1024:.0f} -> {db['end'] / 1024:.0f} KB (+{db['growth'] / 1024:.0f} KB)")
+
+
+def compare(result, baseline):
+    # Относительное изменение ключевых метрик к прошлому прогону (например, другого коммита)
+    metrics = [
+        ('msgs_per_sec', result['msgs_per_sec'], baseline['msgs_per_sec']),
+        ('latency p50', result['latency_ms']['p50'], baseline['latency_ms']['p50']),
+        ('latency p95', result['latency_ms']['p95'], baseline['latency_ms']['p95']),
+        ('latency p99', result['latency_ms']['p99'], baseline['latency_ms']['p99']),
+        ('rss peak', result['server_rss_kb']['peak'], baseline['server_rss_kb']['peak']),
+        ('db growth', result['db_bytes']['growth'], baseline['db_bytes']['growth']),
+    ]
+    print(f"\nvs {baseline.get('commit') or 'baseline'}")
+    for name, value, old in metrics:
+        if value is not None and old:
+            print(f"{name:13} {old:>12.1f} -> {value:>12.1f} ({(value - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=20, help='Количество виртуальных клиентов (парами)')
+    parser.add_argument('--messages', type=int, default=100, help='Сообщений от каждого клиента')
+    parser.add_argument('--size', type=int, default=100, help='Размер открытого текста, байт')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Сообщений в секунду от клиента (0 - без паузы, следующее после ответа)')
+    parser.add_argument('--json', action='store_true', help='JSON вместо бинарного формата')
+    parser.add_argument('--timeout', type=float, default=60, help='Сколько ждать доставки после отправки, сек')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--server-args', default='',
+                        help='Дополнительные аргументы server.py, например "--shards 4" или "--storage log"')
+    parser.add_argument('--output', help='Куда записать результат в JSON')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+    args.clients += args.clients % 2
+
+    with tempfile.TemporaryDirectory(prefix='chat-bench-') as data_dir:
+        # Чистая база и каталог файлов на каждый прогон, чтобы замеры были сравнимы
+        command = [
+            sys.executable, str(SERVER), '--port', str(args.port),
+            '--db', os.path.join(data_dir, 'chat.db'), '--log-dir', os.path.join(data_dir, 'log'),
+            '--files-dir', os.path.join(data_dir, 'files'),
+            # Лимиты частоты сняты, чтобы мерить пропускную способность; --server-args может вернуть их
+            '--send-rate', '0', '--poll-rate', '0', '--register-rate', '0', '--ip-rate', '0',
+        ] + shlex.split(args.server_args)
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base_url = f'http://localhost:{args.port}'
+        try:
+            asyncio.run(wait_for_server(base_url, process))
+            result = asyncio.run(run(args, base_url, process, data_dir))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print_report(result)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Рассылка нескольким получателям: /message/multi против отдельных отправок каждому -
+задержка отправки и объём сохранённых данных в зависимости от числа получателей"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_load import SERVER, VirtualClient, wait_for_server
+from client import send_text, send_group
+
+PORT = 8097
+
+
+def stored_bytes(db_path):
+    # Шифротексты и обёрнутые ключи в messages плюс общие blob рассылок
+    conn = sqlite3.connect(db_path)
+    try:
+        messages = conn.execute('SELECT coalesce(sum(length(encrypted_message)), 0) FROM messages').fetchone()[0]
+        blobs = conn.execute('SELECT coalesce(sum(length(data)), 0) FROM blobs').fetchone()[0]
+        return messages + blobs
+    finally:
+        conn.close()
+
+
+async def measure(send, count, db_path):
+    before = stored_bytes(db_path)
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        await send()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies), (stored_bytes(db_path) - before) / count
+
+
+async def run(args, base_url, db_path):
+    sender = VirtualClient(0, not args.json)
+    recipients = [VirtualClient(i + 1, not args.json) for i in range(max(args.recipients))]
+    await asyncio.gather(*(client.register(base_url) for client in [sender] + recipients))
+    peers = []
+    for recipient in recipients:
+        await sender.connect(base_url, recipient)
+        peers.append((recipient.user_id, recipient.username, sender.peer_public_key))
+    text = 'x' * args.size
+    results = []
+    try:
+        for n in args.recipients:
+            group = peers[:n]
+
+            async def each():
+                for peer_id, _, public_key in group:
+                    await send_text(sender.session, base_url, sender.user_id, sender.crypto, peer_id, public_key,
+                                    sender.binary, text)
+
+            async def multi():
+                await send_group(sender.session, base_url, sender.user_id, sender.crypto, group, sender.binary, text)
+
+            each_result = await measure(each, args.messages, db_path)
+            results.append((n, each_result, await measure(multi, args.messages, db_path)))
+    finally:
+        await asyncio.gather(*(client.close() for client in [sender] + recipients))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--recipients', type=int, nargs='+', default=[1, 2, 5, 10, 20],
+                        help='Числа получателей для замеров')
+    parser.add_argument('--messages', type=int, default=50, help='Сообщений на замер')
+    parser.add_argument('--size', type=int, default=4096, help='Размер открытого текста, байт')
+    parser.add_argument('--json', action='store_true', help='JSON вместо бинарного формата')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='chat-bench-') as data_dir:
+        db_path = os.path.join(data_dir, 'chat.db')
+        command = [
+            sys.executable, str(SERVER), '--port', str(args.port), '--db', db_path,
+            '--files-dir', os.path.join(data_dir, 'files'),
+            '--send-rate', '0', '--register-rate', '0', '--ip-rate', '0',
+        ]
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base_url = f'http://localhost:{args.port}'
+        try:
+            asyncio.run(wait_for_server(base_url, process))
+            results = asyncio.run(run(args, base_url, db_path))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"payload {args.size} bytes, {args.messages} messages per point")
+    print(f"{'recipients':>10} {'each ms':>10} {'multi ms':>10} {'each KB/msg':>12} {'multi KB/msg':>13}")
+    for n, (each_ms, each_bytes), (multi_ms, multi_bytes) in results:
+        print(f"{n:>10} {each_ms:>10.2f} {multi_ms:>10.2f} {each_bytes / 1024:>12.1f} {multi_bytes / 1024:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
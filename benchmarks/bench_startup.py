@@ -0,0 +1,110 @@
+"""Время запуска клиента: от старта процесса client.py до получения собеседником первого сообщения"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_load import ROOT, SERVER, VirtualClient, wait_for_server, read_messages
+from key_manager import get_user_id
+
+CLIENT = ROOT / 'client' / 'client.py'
+PORT = 8098
+USERNAME = 'startup'
+TARGET_MS = 500  # Допустимая медиана с прогретым кэшем ключей, мс
+
+# Состояние клиента перед запуском: какие файлы удалить из его каталога
+MODES = [
+    ('cold', ('.key', '.db')),  # первый запуск: генерация ключа и вывод общего ключа
+    ('no cache', ('.db',)),  # ключ есть, общий ключ выводится заново (как до кэша)
+    ('warm', ()),  # ключ собеседника и общий ключ из кэша
+]
+
+
+async def first_message(base_url, peer, sender_id, last_id, timeout):
+    # Ждём у собеседника сообщение от клиента, возвращаем курсор после него
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        url = f'{base_url}/messages?user_id={peer.user_id.hex()}&last_id={last_id}&wait=1'
+        async with peer.session.get(url) as resp:
+            for msg in await read_messages(resp):
+                last_id = msg['id']
+                if msg['sender_id'] == sender_id:
+                    return last_id
+    raise RuntimeError('Сообщение от клиента не пришло')
+
+
+async def run(args, base_url):
+    peer = VirtualClient(0, True)
+    await peer.register(base_url)
+    sender_id = get_user_id(USERNAME)
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    results = {name: [] for name, _ in MODES}
+    last_id = 0
+    try:
+        with tempfile.TemporaryDirectory(prefix='chat-client-') as client_dir:
+            for _ in range(args.runs):
+                for name, remove in MODES:
+                    for suffix in remove:
+                        path = os.path.join(client_dir, USERNAME + suffix)
+                        if os.path.exists(path):
+                            os.remove(path)
+                    start = time.perf_counter()
+                    client = subprocess.Popen(
+                        [sys.executable, str(CLIENT), USERNAME, peer.username, base_url],
+                        cwd=client_dir, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL
+                    )
+                    try:
+                        # Строка ждёт в stdin, клиент отправит её, как только будет готов
+                        client.stdin.write(b'hello\n')
+                        client.stdin.flush()
+                        last_id = await first_message(base_url, peer, sender_id, last_id, args.timeout)
+                        results[name].append((time.perf_counter() - start) * 1000)
+                    finally:
+                        client.kill()
+                        client.wait()
+    finally:
+        await peer.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='Запусков в каждом режиме')
+    parser.add_argument('--target', type=float, default=TARGET_MS,
+                        help='Допустимая медиана в режиме warm, мс (больше - код возврата 1)')
+    parser.add_argument('--timeout', type=float, default=30, help='Сколько ждать первого сообщения, сек')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='chat-bench-') as data_dir:
+        command = [
+            sys.executable, str(SERVER), '--port', str(args.port),
+            '--db', os.path.join(data_dir, 'chat.db'), '--files-dir', os.path.join(data_dir, 'files'),
+            # Каждый запуск клиента регистрируется заново - лимит регистраций снят
+            '--register-rate', '0', '--ip-rate', '0',
+        ]
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base_url = f'http://localhost:{args.port}'
+        try:
+            asyncio.run(wait_for_server(base_url, process))
+            results = asyncio.run(run(args, base_url))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"{'mode':10} {'median ms':>10} {'min ms':>10} {'max ms':>10}")
+    for name, _ in MODES:
+        values = results[name]
+        print(f"{name:10} {statistics.median(values):>10.0f} {min(values):>10.0f} {max(values):>10.0f}")
+    warm = statistics.median(results['warm'])
+    if warm > args.target:
+        print(f"warm median {warm:.0f} ms exceeds target {args.target:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
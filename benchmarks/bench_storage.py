@@ -0,0 +1,83 @@
+"""Хранилища сервера: скорость записи, чтения и восстановления (поведение проверяет tests/test_storage.py)"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'server'))
+
+from database import Database
+from memory_storage import MemoryStorage
+from log_storage import LogStorage
+
+
+BACKENDS = {
+    'sqlite': lambda directory, args: Database(os.path.join(directory, 'chat.db')),
+    'memory': lambda directory, args: MemoryStorage(),
+    'log': lambda directory, args: LogStorage(os.path.join(directory, 'log'), segment_size=args.segment_size),
+}
+
+
+async def bench(make, directory, args):
+    storage = make(directory, args)
+    recipients = [i.to_bytes(16, 'big') for i in range(args.users)]
+    for recipient_id in recipients:
+        await storage.register_user(recipient_id, b'KEY', 'user')
+    payload = os.urandom(args.size)
+
+    start = time.perf_counter()
+    for offset in range(0, args.messages, args.concurrency):
+        count = min(args.concurrency, args.messages - offset)
+        await asyncio.gather(*(
+            storage.add_message(recipients[0], random.choice(recipients), payload, time.time())
+            for _ in range(count)
+        ))
+    write = args.messages / (time.perf_counter() - start)
+
+    latencies = []
+    for _ in range(args.reads):
+        start = time.perf_counter()
+        await storage.get_messages(random.choice(recipients), 0, 100)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    result = {'write msg/s': write, 'read p50 ms': latencies[len(latencies) // 2] * 1000,
+              'read p99 ms': latencies[int(len(latencies) * 0.99)] * 1000}
+    if any(Path(directory).iterdir()):
+        # Восстановление замеряем только у хранилищ, которые что-то записали на диск
+        storage.close()
+        start = time.perf_counter()
+        storage = make(directory, args)
+        result['reopen ms'] = (time.perf_counter() - start) * 1000
+        result['disk MB'] = sum(p.stat().st_size for p in Path(directory).rglob('*') if p.is_file()) / 2 ** 20
+    storage.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=200, help='Размер шифротекста, байт')
+    parser.add_argument('--concurrency', type=int, default=500, help='Одновременных отправок')
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--segment-size', type=int, default=16 * 1024 ** 2)
+    args = parser.parse_args()
+
+    columns = ['write msg/s', 'read p50 ms', 'read p99 ms', 'reopen ms', 'disk MB']
+    print(f"{'backend':8}" + ''.join(f'{column:>13}' for column in columns))
+    for name in args.backends:
+        with tempfile.TemporaryDirectory() as directory:
+            result = asyncio.run(bench(BACKENDS[name], directory, args))
+        print(f"{name:8}" + ''.join(
+            f'{result[column]:>13.2f}' if column in result else f"{'-':>13}" for column in columns
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Сравнение JSON (hex) и бинарного формата: размер на проводе и CPU на сообщение"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.protocols import MessageProtocol
+
+
+def encode_message_json(sender_id, recipient_id, encrypted_message):
+    return json.dumps({
+        'sender_id': sender_id.hex(),
+        'recipient_id': recipient_id.hex(),
+        'encrypted_message': encrypted_message.hex()
+    }).encode()
+
+
+def decode_message_json(data):
+    data = json.loads(data)
+    return (
+        bytes.fromhex(data['sender_id']),
+        bytes.fromhex(data['recipient_id']),
+        bytes.fromhex(data['encrypted_message'])
+    )
+
+
+def per_call_us(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench(size, page, repeat):
+    sender_id, recipient_id = os.urandom(16), os.urandom(16)
+    encrypted = os.urandom(size)
+    rows = [(i, sender_id, encrypted, time.time(), None) for i in range(1, page + 1)]
+
+    post = {
+        'json': encode_message_json(sender_id, recipient_id, encrypted),
+        'binary': MessageProtocol.encode_message_binary(sender_id, recipient_id, encrypted)
+    }
+    post_codec = {
+        'json': (lambda m: encode_message_json(*m), decode_message_json),
+        'binary': (lambda m: MessageProtocol.encode_message_binary(*m), MessageProtocol.decode_message_binary)
+    }
+    page_body = {
+        'json': MessageProtocol.encode_rows_json(rows),
+        'binary': MessageProtocol.encode_rows_binary(rows)
+    }
+    page_codec = {
+        'json': (MessageProtocol.encode_rows_json, MessageProtocol.decode_rows_json),
+        'binary': (MessageProtocol.encode_rows_binary, MessageProtocol.decode_rows_binary)
+    }
+
+    print(f"\nciphertext {size} B, page of {page} rows")
+    print(f"{'format':8} {'POST bytes':>11} {'enc us':>8} {'dec us':>8} "
+          f"{'page bytes/msg':>15} {'enc us/msg':>11} {'dec us/msg':>11}")
+    for name in ('json', 'binary'):
+        encode, decode = post_codec[name]
+        page_encode, page_decode = page_codec[name]
+        page_repeat = max(1, repeat // page)
+        print(f"{name:8} {len(post[name]):>11} "
+              f"{per_call_us(encode, (sender_id, recipient_id, encrypted), repeat):>8.2f} "
+              f"{per_call_us(decode, post[name], repeat):>8.2f} "
+              f"{len(page_body[name]) / page:>15.1f} "
+              f"{per_call_us(page_encode, rows, page_repeat) / page:>11.2f} "
+              f"{per_call_us(page_decode, page_body[name], page_repeat) / page:>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 16384],
+                        help='Размеры шифротекста, байт')
+    parser.add_argument('--page', type=int, default=100, help='Строк в ответе GET /messages')
+    parser.add_argument('--repeat', type=int, default=20000)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        bench(size, args.page, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Разбор трассировок доставки (CHAT_TRACE_FILE): задержка по этапам от отправки до показа"""
+import argparse
+import json
+import statistics
+from collections import defaultdict
+
+# Отрезки между соседними этапами в порядке прохождения сообщения
+SEGMENTS = [
+    ('encrypt', 'client_send', 'client_encrypted'),
+    ('upload', 'client_encrypted', 'server_received'),
+    ('validate', 'server_received', 'server_insert'),
+    ('sqlite insert', 'server_insert', 'server_stored'),
+    ('poll wait', 'server_stored', 'server_delivered'),
+    ('download', 'server_delivered', 'client_received'),
+    ('decrypt', 'client_received', 'client_decrypted'),
+    ('display', 'client_decrypted', 'client_displayed'),
+    ('post round trip', 'client_send', 'client_sent'),
+    ('total', 'client_send', 'client_displayed'),
+]
+
+
+def load(paths):
+    # Половины отправителя и получателя (возможно, из разных файлов) склеиваются по id
+    traces = defaultdict(dict)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    traces[record['id']].update(record['stages'])
+    return traces
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', nargs='+', help='Файлы трассировки клиентов (JSON Lines)')
+    parser.add_argument('--output', help='Куда записать длительности этапов по каждому сообщению в JSON')
+    args = parser.parse_args()
+
+    traces = load(args.files)
+    durations = defaultdict(list)
+    per_trace = {}
+    for trace_id, stages in traces.items():
+        per_trace[trace_id] = {}
+        for name, start, end in SEGMENTS:
+            if start in stages and end in stages:
+                value = (stages[end] - stages[start]) * 1000
+                durations[name].append(value)
+                per_trace[trace_id][name] = value
+
+    print(f"traces: {len(traces)} (complete: {len(durations['total'])})")
+    print(f"{'segment':16} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, _, _ in SEGMENTS:
+        values = sorted(durations[name])
+        if not values:
+            continue
+        if len(values) > 1:
+            cuts = statistics.quantiles(values, n=100, method='inclusive')
+            p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+        else:
+            p50 = p95 = p99 = values[0]
+        print(f"{name:16} {len(values):>6} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} {values[-1]:>9.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(per_trace, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,138 +1,539 @@
 import asyncio
+import json
+import os
+import random
 import sys
-from aiohttp import ClientSession, ClientError
+import time
+from aiohttp import ClientSession, ClientError, TCPConnector
 from cryptography.hazmat.primitives import serialization
 
-from shared.crypto_utils import deserialize_public_key
-from crypto import CryptoManager
+from crypto import CryptoManager, key_fingerprint
 from key_manager import load_or_generate_keys, get_user_id
-from shared.protocols import MessageProtocol
+from store import MessageStore
+from transfer import upload_file, download_file
+from tracing import tracing_enabled, start_trace, trace_stage, dump_trace
+from shared.protocols import (
+    MessageProtocol, BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, ROW_HEADER, FILE_NOTICE_PREFIX, MAX_BODY_SIZE,
+    ack_signing_data
+)
 from shared.utils import format_message
 
+POLL_INTERVAL = 0.3  # Интервал опроса, если сервер не поддерживает long-poll
+LONG_POLL_WAIT = 30
+DRAIN_PAGE_SIZE = 500  # Размер страницы при выгрузке накопившихся сообщений
+DRAIN_BATCH = 50  # Сколько сообщений из потока расшифровывать за раз
+RETRY_STATUSES = (429, 503)  # Сервер ограничил частоту или перегружен - повторить позже
+RETRY_DELAY = 1  # Пауза перед повтором, если сервер не прислал Retry-After, сек
+MAX_RETRY_DELAY = 30
+SEND_RETRIES = 5  # Попыток отправки, прежде чем сообщить об ошибке
+KEEPALIVE_TIMEOUT = 60  # Сколько держать простаивающее соединение для следующей отправки, сек
 
-async def receive_messages(base_url, user_id, crypto, peer_public_key):
-    last_id = 0
-    async with ClientSession() as session:
-        while True:
-            try:
-                url = f"{base_url}/messages?user_id={user_id.hex()}&last_id={last_id}"
-                async with session.get(url) as resp:
-                    if resp.status == 200:
-                        messages = await resp.json()
-                        for msg in messages:
-                            # Получаем имя отправителя
-                            sender_id = bytes.fromhex(msg['sender_id'])
-                            async with session.get(
-                                    f"{base_url}/user_public_key?user_id={sender_id.hex()}") as user_resp:
-                                if user_resp.status == 200:
-                                    # Запрашиваем имя пользователя
-                                    async with session.get(
-                                            f"{base_url}/user_info?user_id={sender_id.hex()}") as info_resp:
-                                        if info_resp.status == 200:
-                                            user_info = await info_resp.json()
-                                            sender_name = user_info['username']
-                                        else:
-                                            sender_name = "Unknown"
-                                else:
-                                    sender_name = "Unknown"
-
-                            encrypted = bytes.fromhex(msg['encrypted_message'])
-                            decrypted = crypto.decrypt_message(peer_public_key, encrypted)
-                            print(format_message({
-                                'sender_name': sender_name,  # Используем имя вместо ID
-                                'text': decrypted.decode(),
-                                'timestamp': msg['timestamp']
-                            }))
-                            last_id = max(last_id, msg['id'])
-                    elif resp.status != 404:
-                        error = await resp.text()
-                        print(f"\nServer error ({resp.status}): {error}")
-            except ClientError as e:
-                print(f"\nNetwork error: {str(e)}")
-            except Exception as e:
-                print(f"\nUnknown error: {str(e)}")
-            await asyncio.sleep(0.3)
-
-
-async def send_messages(base_url, user_id, crypto, peer_id, peer_public_key):
-    async with ClientSession() as session:
-        while True:
+
+def print_message(msg):
+    text = msg['text'] if msg['text'] is not None else "<decryption failed>"
+    if text.startswith(FILE_NOTICE_PREFIX):
+        # Уведомление пишет собеседник: испорченное показываем как обычный текст
+        try:
+            info = json.loads(text[len(FILE_NOTICE_PREFIX):])
+            text = f"sent file {info['name']} ({info['size']} bytes). Download: /get {info['id']} {info['name']}"
+        except (ValueError, KeyError, TypeError):
+            pass
+    print(format_message(dict(msg, text=text)))
+
+
+def retry_delay(resp, attempt=0):
+    # None - повторять не нужно. Случайная добавка разносит повторы клиентов во времени,
+    # чтобы они не пришли все разом в момент, указанный сервером
+    if resp.status not in RETRY_STATUSES:
+        return None
+    try:
+        delay = float(resp.headers['Retry-After'])
+    except (KeyError, ValueError):
+        delay = RETRY_DELAY * 2 ** attempt
+    return min(delay, MAX_RETRY_DELAY) * random.uniform(1, 1.5)
+
+
+async def post_with_retry(session, url, **request):
+    # Ответ возвращается открытым, как у session.post: async with await post_with_retry(...)
+    for attempt in range(SEND_RETRIES):
+        resp = await session.post(url, **request)
+        delay = retry_delay(resp, attempt)
+        if delay is None or attempt == SEND_RETRIES - 1:
+            return resp
+        resp.release()
+        await asyncio.sleep(delay)
+
+
+async def lookup_senders(session, base_url, sender_cache, sender_ids):
+    # Запрашиваем одним вызовом только тех отправителей, которых ещё не видели
+    unknown = [sender_id for sender_id in sender_ids if sender_id not in sender_cache]
+    if not unknown:
+        return
+    async with await post_with_retry(session, f"{base_url}/users/lookup", json={'user_ids': unknown}) as resp:
+        if resp.status != 200:
+            # Без ключей страница сохранилась бы нерасшифрованной, а курсор и подтверждение
+            # ушли бы дальше - и сервер удалил бы эти сообщения. Страница обрабатывается заново
+            raise ValueError(f"Sender lookup failed ({resp.status}): {await resp.text()}")
+        sender_cache.update(await resp.json())
+
+
+async def ack_messages(session, base_url, user_id, crypto, last_id):
+    # Подтверждаем уже сохранённое локально - сервер может удалить эти сообщения.
+    # Подпись своим ключом доказывает серверу, что подтверждает сам получатель
+    timestamp = time.time()
+    signature = await crypto.sign_async(ack_signing_data(user_id, last_id, timestamp))
+    async with session.post(f"{base_url}/ack", json={
+        'user_id': user_id.hex(),
+        'last_id': last_id,
+        'timestamp': timestamp,
+        'signature': signature.hex()
+    }) as resp:
+        await resp.read()
+
+
+async def read_messages(resp):
+    # Формат ответа определяем по Content-Type: старый сервер всегда отвечает JSON
+    if resp.content_type == BINARY_CONTENT_TYPE:
+        return MessageProtocol.decode_rows_binary(await resp.read())
+    return MessageProtocol.decode_rows_json(await resp.read())
+
+
+async def read_stream(resp):
+    # Строки приходят по мере чтения сервером БД, отдаём их небольшими пачками
+    binary = resp.content_type == BINARY_CONTENT_TYPE
+    batch = []
+    while True:
+        if binary:
             try:
-                line = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
-                if not line:
-                    continue
+                header = await resp.content.readexactly(ROW_HEADER.size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                break
+            length, blob_len = ROW_HEADER.unpack(header)[3:]
+            if length > MAX_BODY_SIZE or blob_len > MAX_BODY_SIZE:
+                # Длины присылает сервер: больше, чем он принимает в запросе, сообщение быть не может
+                raise ValueError(f"Stream row is too large ({length} + {blob_len} bytes)")
+            payload = await resp.content.readexactly(length + blob_len)
+            batch.append(MessageProtocol.decode_row_binary(header, payload))
+        else:
+            line = await resp.content.readline()
+            if not line:
+                break
+            batch.append(MessageProtocol.row_from_json(json.loads(line)))
+        if len(batch) >= DRAIN_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def storage_changed(resp, store):
+    # Сервер сообщает, какое хранилище выдаёт id (X-Storage-Epoch). После смены хранилища
+    # или его сброса id начинаются заново, и сохранённый курсор пропустил бы все новые сообщения
+    epoch = resp.headers.get('X-Storage-Epoch')
+    if epoch is None or epoch == store.epoch():
+        return False
+    if store.epoch() is None:
+        # Клиент раньше не видел epoch: курсор выдан этим же хранилищем
+        store.set_epoch(epoch)
+        return False
+    print("\nServer storage has changed, receiving messages from the start")
+    store.set_epoch(epoch, 0)
+    return True
+
+
+async def decrypt_from(crypto, store, sender_cache, sender_id, messages):
+    # Сообщения одного отправителя расшифровываются одним вызовом его общим ключом
+    sender = sender_cache.get(sender_id.hex())
+    if sender is None:
+        return [None] * len(messages)
+    try:
+        sender_public_key = await load_peer_key(
+            crypto, store, sender_id, sender['username'], sender['public_key'].encode()
+        )
+    except Exception as e:
+        # Негодный ключ одного отправителя (не EC, другая кривая) не должен останавливать
+        # всю страницу: его сообщения сохраняются нерасшифрованными, курсор идёт дальше
+        print(f"Invalid key of {sender['username']}: {str(e)}")
+        return [None] * len(messages)
+    return await crypto.decrypt_many(
+        sender_public_key, [(msg['encrypted_message'], msg.get('blob')) for msg in messages]
+    )
+
+
+async def process_messages(session, base_url, crypto, store, sender_cache, messages, last_id):
+    received_at = time.time()
+    await lookup_senders(
+        session, base_url, sender_cache, {msg['sender_id'].hex() for msg in messages}
+    )
+    # Страница может содержать сообщения разных собеседников - группируем по отправителю
+    by_sender = {}
+    for index, msg in enumerate(messages):
+        by_sender.setdefault(msg['sender_id'], []).append(index)
+    results = await asyncio.gather(*(
+        decrypt_from(crypto, store, sender_cache, sender_id, [messages[index] for index in indexes])
+        for sender_id, indexes in by_sender.items()
+    ))
+    decrypted = [None] * len(messages)
+    for indexes, texts in zip(by_sender.values(), results):
+        for index, text in zip(indexes, texts):
+            decrypted[index] = text
+    decrypted_at = time.time()
+    received = []
+    for msg, text in zip(messages, decrypted):
+        sender = sender_cache.get(msg['sender_id'].hex())
+        received.append({
+            'id': msg['id'],
+            'sender_id': msg['sender_id'],
+            'sender_name': sender['username'] if sender else "Unknown",
+            'text': text.decode(errors='replace') if text is not None else None,
+            # Нерасшифрованное сообщение сохраняем как есть
+            'encrypted_message': msg['encrypted_message'] if text is None else None,
+            'timestamp': msg['timestamp']
+        })
+        print_message(received[-1])
+        last_id = max(last_id, msg['id'])
+        trace = msg.get('trace')
+        if trace is not None:
+            dump_trace(
+                trace, 'recipient',
+                client_received=received_at, client_decrypted=decrypted_at, client_displayed=time.time()
+            )
+    if received:
+        store.save_messages(received, last_id)
+    return last_id
+
+
+async def drain_backlog(session, base_url, user_id, crypto, headers, store, sender_cache, last_id):
+    # Всё накопившееся забираем одним потоковым запросом вместо постраничного опроса
+    url = f"{base_url}/messages/stream?user_id={user_id.hex()}&last_id={last_id}&page_size={DRAIN_PAGE_SIZE}"
+    start_id = last_id
+    async with session.get(url, headers=headers) as resp:
+        if resp.status != 200:
+            # Старый сервер: догоняем обычным опросом
+            return last_id
+        if storage_changed(resp, store):
+            # Поток выбран по курсору прежнего хранилища - начинаем с нуля обычным опросом
+            return 0
+        async for messages in read_stream(resp):
+            last_id = await process_messages(session, base_url, crypto, store, sender_cache, messages, last_id)
+    # Подтверждаем только то, что действительно получили в этом запуске
+    if last_id > start_id:
+        await ack_messages(session, base_url, user_id, crypto, last_id)
+    return last_id
+
+
+async def receive_messages(session, base_url, user_id, crypto, binary, store):
+    # Один поток приёма на все диалоги: сообщения любых собеседников приходят одним опросом
+    # Продолжаем с сохранённого курсора, а не скачиваем всю историю заново
+    last_id = store.last_id()
+    sender_cache = {}
+    # Трассировка передаётся только в JSON
+    headers = {'Accept': BINARY_CONTENT_TYPE if binary and not tracing_enabled() else JSON_CONTENT_TYPE}
+    try:
+        last_id = await drain_backlog(session, base_url, user_id, crypto, headers, store, sender_cache, last_id)
+    except ClientError as e:
+        print(f"\nNetwork error: {str(e)}")
+        last_id = store.last_id()
+    except Exception as e:
+        # Оборванный поток или испорченная строка не должны останавливать клиент:
+        # обработанные страницы уже сохранены, остальное догоняем обычным опросом
+        print(f"\nUnknown error: {str(e)}")
+        last_id = store.last_id()
+
+    attempt = 0
+    while True:
+        long_poll = False
+        delay = None
+        try:
+            url = f"{base_url}/messages?user_id={user_id.hex()}&last_id={last_id}&wait={LONG_POLL_WAIT}"
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 200:
+                    if storage_changed(resp, store):
+                        # Страница выбрана по курсору прежнего хранилища - сразу запрашиваем заново
+                        last_id = 0
+                        continue
+                    messages = await read_messages(resp)
+                    last_id = await process_messages(
+                        session, base_url, crypto, store, sender_cache, messages, last_id
+                    )
+                    if messages:
+                        await ack_messages(session, base_url, user_id, crypto, last_id)
+                    # Старый сервер игнорирует wait и отвечает сразу - тогда опрашиваем по таймеру.
+                    # Без паузы повторяем только после успешно обработанной страницы
+                    long_poll = 'X-Long-Poll' in resp.headers
+                elif resp.status in RETRY_STATUSES:
+                    delay = retry_delay(resp, attempt)
+                elif resp.status != 404:
+                    error = await resp.text()
+                    print(f"\nServer error ({resp.status}): {error}")
+        except ClientError as e:
+            print(f"\nNetwork error: {str(e)}")
+            delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+        except Exception as e:
+            # Страница, которую не удалось обработать, придёт снова - не повторяем её в цикле без пауз
+            print(f"\nUnknown error: {str(e)}")
+            delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+        if delay is not None:
+            # Сервер просит подождать или запрос не удался: паузы растут, пока это повторяется
+            attempt += 1
+            await asyncio.sleep(delay)
+        else:
+            attempt = 0
+            if not long_poll:
+                await asyncio.sleep(POLL_INTERVAL)
+
+
+async def send_text(session, base_url, user_id, crypto, peer_id, peer_public_key, binary, text):
+    trace = start_trace()
+    encrypted = await crypto.encrypt_message_async(peer_public_key, text)
+    trace_stage(trace, 'client_encrypted')
+    if binary and trace is None:
+        request = {
+            'data': MessageProtocol.encode_message_binary(user_id, peer_id, encrypted),
+            'headers': {'Content-Type': BINARY_CONTENT_TYPE}
+        }
+    else:
+        request = {'json': {
+            'sender_id': user_id.hex(),
+            'recipient_id': peer_id.hex(),
+            'encrypted_message': encrypted.hex()
+        }}
+        if trace is not None:
+            request['json']['trace'] = trace
+    async with await post_with_retry(session, f"{base_url}/message", **request) as resp:
+        if resp.status != 200:
+            error = await resp.text()
+            print(f"Send error ({resp.status}): {error}")
+        elif trace is not None:
+            # Этапы сервера до коммита включительно приходят в заголовке ответа
+            trace['stages'].update(json.loads(resp.headers.get('X-Trace-Stages', '{}')))
+            trace_stage(trace, 'client_sent')
+            dump_trace(trace, 'sender')
+
+
+async def send_group(session, base_url, user_id, crypto, peers, binary, text):
+    # Сообщение шифруется один раз, каждому получателю уходит только обёрнутый его ключом
+    # ключ сообщения: объём запроса и хранения растёт с числом получателей, а не с размером текста
+    blob, wrapped_keys = await crypto.encrypt_for_many_async([peer[2] for peer in peers], text)
+    recipients = [(peer[0], wrapped_key) for peer, wrapped_key in zip(peers, wrapped_keys)]
+    if binary:
+        request = {
+            'data': MessageProtocol.encode_multi_binary(user_id, recipients, blob),
+            'headers': {'Content-Type': BINARY_CONTENT_TYPE}
+        }
+    else:
+        request = {'json': {
+            'sender_id': user_id.hex(),
+            'encrypted_message': blob.hex(),
+            'recipients': [
+                {'recipient_id': recipient_id.hex(), 'encrypted_message': wrapped_key.hex()}
+                for recipient_id, wrapped_key in recipients
+            ]
+        }}
+    async with await post_with_retry(session, f"{base_url}/message/multi", **request) as resp:
+        if resp.status != 200:
+            error = await resp.text()
+            print(f"Send error ({resp.status}): {error}")
+
 
-                text = line.rstrip('\n')
-                if not text.strip():
+async def send_file(session, base_url, user_id, crypto, peer_id, peer_public_key, binary, path):
+    # Файл уходит потоком зашифрованных чанков, собеседник получает уведомление обычным сообщением
+    key = await crypto.derive_shared_key_async(peer_public_key)
+    file_id = await upload_file(session, base_url, user_id, peer_id, key, path, crypto.executor)
+    notice = FILE_NOTICE_PREFIX + json.dumps({
+        'id': file_id,
+        'name': os.path.basename(path),
+        'size': os.path.getsize(path)
+    })
+    await send_text(session, base_url, user_id, crypto, peer_id, peer_public_key, binary, notice)
+    print(f"File {path} sent")
+
+
+async def receive_file(session, base_url, user_id, crypto, store, file_id, name=None):
+    # Имя берём только как базовое, чтобы уведомление не могло указать путь вне текущего каталога
+    path = os.path.basename(name) if name else file_id
+
+    async def sender_key(sender_id):
+        # Файл мог прислать любой собеседник - ключ выбирается по отправителю из ответа сервера
+        cached = crypto.peer_keys.get(sender_id)
+        if cached is not None:
+            sender_public_key = cached[1]
+        else:
+            pem_key, error = await fetch_peer_key(session, base_url, sender_id)
+            sender_public_key = await load_peer_key(crypto, store, sender_id, sender_id.hex(), pem_key)
+            if sender_public_key is None:
+                raise ValueError(f"Failed to get sender key: {error}")
+        return await crypto.derive_shared_key_async(sender_public_key)
+
+    path, size = await download_file(session, base_url, user_id, sender_key, file_id, path, crypto.executor)
+    print(f"File saved to {path} ({size} bytes)")
+
+
+async def send_messages(session, base_url, user_id, crypto, store, binary, peers=None):
+    # peers - список (peer_id, имя, открытый ключ) текущих собеседников, меняется командой /to
+    while True:
+        try:
+            line = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
+            if not line:
+                continue
+
+            text = line.rstrip('\n')
+            if not text.strip():
+                continue
+
+            command, _, args = text.partition(' ')
+            if command == '/to' and args.strip():
+                peers = await open_peers(session, base_url, crypto, store, args.strip()) or peers
+                if peers:
+                    print(f"You are chatting with: {', '.join(peer[1] for peer in peers)}")
+            elif command == '/get' and args:
+                await receive_file(session, base_url, user_id, crypto, store, *args.split(maxsplit=1))
+            elif not peers:
+                print("Choose a peer first: /to <peer_name>[,<peer_name>...]")
+            elif command == '/file' and args:
+                if len(peers) > 1:
+                    print("Files are sent to one peer at a time: /to <peer_name>")
                     continue
+                await send_file(session, base_url, user_id, crypto, peers[0][0], peers[0][2], binary, args)
+            elif len(peers) > 1:
+                await send_group(session, base_url, user_id, crypto, peers, binary, text)
+            else:
+                await send_text(session, base_url, user_id, crypto, peers[0][0], peers[0][2], binary, text)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+
+
+async def register(session, base_url, user_id, private_key, username):
+    # Возвращает, поддерживает ли сервер бинарный формат, или None, если регистрация не удалась
+    public_key_bytes = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    # Сначала пробуем бинарный формат, сервер без его поддержки отклонит запрос
+    register_data = MessageProtocol.encode_register_binary(user_id, public_key_bytes, username)
+    async with await post_with_retry(session, f"{base_url}/register", data=register_data,
+                                     headers={'Content-Type': BINARY_CONTENT_TYPE}) as resp:
+        if resp.status == 200:
+            return True
+
+    register_data = MessageProtocol.encode_register(
+        user_id,
+        public_key_bytes.decode('utf-8'),
+        username
+    )
+    async with await post_with_retry(session, f"{base_url}/register", data=register_data) as resp:
+        if resp.status != 200:
+            print(f"Registration failed: {await resp.text()}")
+            return None
+    return False
+
+
+async def fetch_peer_key(session, base_url, peer_id):
+    # (PEM, None) или (None, текст ошибки)
+    try:
+        async with session.get(f"{base_url}/user_public_key?user_id={peer_id.hex()}") as resp:
+            if resp.status != 200:
+                return None, await resp.text()
+            return (await resp.text()).encode(), None
+    except ClientError as e:
+        return None, str(e)
+
 
-                encrypted = crypto.encrypt_message(peer_public_key, text)
-                data = {
-                    'sender_id': user_id.hex(),
-                    'recipient_id': peer_id.hex(),
-                    'encrypted_message': encrypted.hex()
-                }
-                async with session.post(f"{base_url}/message", json=data) as resp:
-                    if resp.status != 200:
-                        error = await resp.text()
-                        print(f"Send error ({resp.status}): {error}")
-            except Exception as e:
-                print(f"Error: {str(e)}")
+async def load_peer_key(crypto, store, peer_id, peer_name, pem):
+    # Общий ключ берётся из памяти или локального кэша, если он выведен для этих же двух
+    # открытых ключей, иначе выводится заново (PBKDF2 - в пуле потоков) и сохраняется
+    if pem is None:
+        cached = store.peer_key(peer_id)
+        if cached is None:
+            return None
+        # Сервер недоступен или не ответил - продолжаем с ключом из кэша
+        pem = cached[0]
+    peer_public_key = crypto.peer_public_key(peer_id, pem)
+    fingerprint = key_fingerprint(peer_public_key)
+    if fingerprint in crypto.shared_keys:
+        return peer_public_key
+    cached = store.peer_key(peer_id)
+    own_fingerprint = key_fingerprint(crypto.public_key)
+    if cached is not None and cached[1] == fingerprint and cached[2] == own_fingerprint:
+        crypto.shared_keys[fingerprint] = cached[3]
+        return peer_public_key
+    if cached is not None and cached[1] != fingerprint:
+        print(f"Warning: {peer_name}'s public key has changed")
+    shared_key = await crypto.derive_shared_key_async(peer_public_key)
+    store.save_peer_key(peer_id, pem, fingerprint, own_fingerprint, shared_key)
+    return peer_public_key
+
+
+async def open_conversation(session, base_url, crypto, store, peer_name):
+    # (peer_id, имя, открытый ключ) собеседника или None, если его ключа нет ни на сервере, ни в кэше
+    peer_id = get_user_id(peer_name)
+    pem_key, error = await fetch_peer_key(session, base_url, peer_id)
+    try:
+        peer_public_key = await load_peer_key(crypto, store, peer_id, peer_name, pem_key)
+    except ValueError as e:
+        print(f"Invalid peer key format: {str(e)}")
+        return None
+    if peer_public_key is None:
+        print(f"Failed to get peer key: {error}")
+        return None
+    return peer_id, peer_name, peer_public_key
+
+
+async def open_peers(session, base_url, crypto, store, names):
+    # "alice" или "alice,bob": список собеседников или None, если чей-то ключ получить не удалось
+    names = list(dict.fromkeys(name.strip() for name in names.split(',') if name.strip()))
+    peers = await asyncio.gather(*(open_conversation(session, base_url, crypto, store, name) for name in names))
+    if not peers or None in peers:
+        return None
+    return peers
 
 
 async def main():
-    if len(sys.argv) < 3:
-        print("Usage: python client.py <your_name> <peer_name> [server_url]")
+    if len(sys.argv) < 2:
+        print("Usage: python client.py <your_name> [peer_name[,peer_name...]] [server_url]")
         return
 
     username = sys.argv[1]
-    peer_name = sys.argv[2]
-    base_url = sys.argv[3] if len(sys.argv) > 3 else 'http://localhost:8080'
+    # Собеседник при запуске необязателен (его выбирают командой /to), адрес сервера узнаём по схеме
+    peer_names = [arg for arg in sys.argv[2:] if '://' not in arg]
+    base_url = next((arg for arg in sys.argv[2:] if '://' in arg), 'http://localhost:8080')
 
     # Генерация ключей
     user_id, private_key = load_or_generate_keys(username)
     crypto = CryptoManager(private_key)
+    store = MessageStore(username)
 
-    # ID собеседника
-    peer_id = get_user_id(peer_name)
-
-    async with ClientSession() as session:
-        # Регистрация
-        public_key_bytes = private_key.public_key().public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        register_data = MessageProtocol.encode_register(
-            user_id,
-            public_key_bytes.decode('utf-8'),
-            username
-        )
-        async with session.post(f"{base_url}/register", data=register_data) as resp:
-            if resp.status != 200:
-                print(f"Registration failed: {await resp.text()}")
-                return
-
-        # Получение ключа собеседника
-        async with session.get(f"{base_url}/user_public_key?user_id={peer_id.hex()}") as resp:
-            if resp.status != 200:
-                print(f"Failed to get peer key: {await resp.text()}")
+    # Одна сессия с пулом keep-alive соединений на весь клиент: приём и отправка
+    # не открывают новых TCP-соединений на каждый запрос
+    try:
+        async with ClientSession(connector=TCPConnector(keepalive_timeout=KEEPALIVE_TIMEOUT)) as session:
+            # Регистрация и получение ключа собеседника независимы - выполняются одновременно
+            setup = [register(session, base_url, user_id, private_key, username)]
+            if peer_names:
+                setup.append(open_peers(session, base_url, crypto, store, peer_names[0]))
+            binary, *peers = await asyncio.gather(*setup)
+            if binary is None:
                 return
+            peers = peers[0] if peers else None
 
-            try:
-                pem_key = (await resp.text()).encode()
-                peer_public_key = deserialize_public_key(pem_key)
-            except ValueError as e:
-                print(f"Invalid peer key format: {str(e)}")
-                return
+            print(f"Welcome to secure chat, {username}!")
+            if peers:
+                print(f"You are chatting with: {', '.join(peer[1] for peer in peers)}")
+            print("Type messages and press Enter. /to <peer_name>[,<peer_name>...] switches the conversation, "
+                  "/file <path> sends a file. Ctrl+C to exit.\n")
 
-    print(f"Welcome to secure chat, {username}!")
-    print(f"You are chatting with: {peer_name}")
-    print("Type messages and press Enter. Ctrl+C to exit.\n")
+            # Локальная история выводится с диска, без запросов к серверу
+            for msg in store.recent():
+                print_message(msg)
 
-    await asyncio.gather(
-        receive_messages(base_url, user_id, crypto, peer_public_key),
-        send_messages(base_url, user_id, crypto, peer_id, peer_public_key)
-    )
+            await asyncio.gather(
+                receive_messages(session, base_url, user_id, crypto, binary, store),
+                send_messages(session, base_url, user_id, crypto, store, binary, peers)
+            )
+    finally:
+        store.close()
 
 
 if __name__ == '__main__':
@@ -1,27 +1,47 @@
-import time
+import asyncio
 import hashlib
+import os
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
-import os
+
+from shared.crypto_utils import deserialize_public_key
+from shared.protocols import encrypt_message, decrypt_message
+
+DECRYPT_FAILURE_DELAY = 0.5  # Пауза после неудачной расшифровки, сек
+
+
+def key_fingerprint(public_key):
+    # Отпечаток открытого ключа - SHA-256 его PEM, им же помечаются общие ключи в кэше
+    return hashlib.sha256(
+        public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+    ).digest()
 
 
 class CryptoManager:
-    def __init__(self, private_key):
+    def __init__(self, private_key, executor=None):
         self.private_key = private_key
         self.public_key = private_key.public_key()
+        # Общие ключи по отпечатку открытого ключа собеседника: сменивший ключ отправитель
+        # не расшифровывается старым общим ключом
         self.shared_keys = {}
+        self.peer_keys = {}  # peer_id -> (PEM, открытый ключ) каждого собеседника и отправителя
+        # Криптография выполняется в пуле потоков (по умолчанию - пул цикла событий),
+        # чтобы PBKDF2 и расшифровка не останавливали приём и отправку
+        self.executor = executor
+
+    def peer_public_key(self, peer_id, pem):
+        # PEM разбирается один раз на собеседника и заново - только если ключ сменился
+        cached = self.peer_keys.get(peer_id)
+        if cached is None or cached[0] != pem:
+            cached = self.peer_keys[peer_id] = (pem, deserialize_public_key(pem))
+        return cached[1]
 
     def derive_shared_key(self, peer_public_key):
         # Создаем уникальный ключ для каждой пары
-        key_id = hashlib.sha256(
-            peer_public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-        ).digest()
+        key_id = key_fingerprint(peer_public_key)
 
         if key_id in self.shared_keys:
             return self.shared_keys[key_id]
@@ -43,34 +63,60 @@ class CryptoManager:
 
     def encrypt_message(self, peer_public_key, message):
         key = self.derive_shared_key(peer_public_key)
-        iv = os.urandom(16)
-
-        # Шифрование
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-        encryptor = cipher.encryptor()
-
-        # PKCS7 паддинг
-        padder = padding.PKCS7(128).padder()
-        padded_data = padder.update(message.encode()) + padder.finalize()
-
-        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-        return iv + ciphertext
+        return encrypt_message(key, message)
 
     def decrypt_message(self, peer_public_key, encrypted_data):
         try:
             key = self.derive_shared_key(peer_public_key)
-            iv = encrypted_data[:16]
-            ciphertext = encrypted_data[16:]
-
-            # Дешифрование
-            cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-            decryptor = cipher.decryptor()
-            padded_data = decryptor.update(ciphertext) + decryptor.finalize()
-
-            # Удаление паддинга
-            unpadder = padding.PKCS7(128).unpadder()
-            return unpadder.update(padded_data) + unpadder.finalize()
+            return decrypt_message(key, encrypted_data)
         except Exception as e:
-            time.sleep(0.5)  # Защита от timing-атак
-            print(f"Decryption error: {str(e)}")
             raise ValueError("Decryption failed") from e
+
+    def encrypt_for_many(self, peer_public_keys, message):
+        # Сообщение шифруется один раз случайным ключом, получателям отправляется только он,
+        # обёрнутый общим ключом пары. Возвращает (blob, [обёрнутые ключи])
+        content_key = os.urandom(32)
+        blob = encrypt_message(content_key, message)
+        wrapped_keys = [encrypt_message(self.derive_shared_key(key), content_key) for key in peer_public_keys]
+        return blob, wrapped_keys
+
+    def sign(self, data):
+        return self.private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+    def _decrypt_many(self, peer_public_key, items):
+        # items - пары (encrypted_message, blob); для сообщений рассылки encrypted_message - обёрнутый ключ
+        key = self.derive_shared_key(peer_public_key)
+        results = []
+        for encrypted_data, blob in items:
+            try:
+                if blob is not None:
+                    results.append(decrypt_message(decrypt_message(key, encrypted_data), blob))
+                else:
+                    results.append(decrypt_message(key, encrypted_data))
+            except Exception as e:
+                print(f"Decryption error: {str(e)}")
+                results.append(None)
+        return results
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def derive_shared_key_async(self, peer_public_key):
+        return await self._run(self.derive_shared_key, peer_public_key)
+
+    async def encrypt_message_async(self, peer_public_key, message):
+        return await self._run(self.encrypt_message, peer_public_key, message)
+
+    async def encrypt_for_many_async(self, peer_public_keys, message):
+        return await self._run(self.encrypt_for_many, peer_public_keys, message)
+
+    async def sign_async(self, data):
+        return await self._run(self.sign, data)
+
+    async def decrypt_many(self, peer_public_key, items):
+        # Вся страница расшифровывается за один вызов в пуле, неудачные сообщения - None
+        results = await self._run(self._decrypt_many, peer_public_key, items)
+        if None in results:
+            # Защита от timing-атак без блокировки цикла событий
+            await asyncio.sleep(DECRYPT_FAILURE_DELAY)
+        return results
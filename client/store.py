@@ -0,0 +1,102 @@
+import sqlite3
+
+SCROLLBACK = 50  # Сколько последних сообщений показывать при запуске
+
+
+class MessageStore:
+    """Локальная история и курсор последнего обработанного сообщения (<username>.db рядом с <username>.key)"""
+
+    def __init__(self, username):
+        self.path = f"{username}.db"
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY,
+                    value
+                )
+            ''')
+            # text - расшифрованное сообщение, encrypted_message хранится только если расшифровать не удалось.
+            # id выдаёт хранилище сервера, и после его смены они начинаются заново - поэтому сообщение
+            # определяет пара (epoch, id), а порядок показа - seq
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS history (
+                    seq INTEGER PRIMARY KEY,
+                    epoch TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    sender_id BLOB NOT NULL,
+                    sender_name TEXT NOT NULL,
+                    text TEXT,
+                    encrypted_message BLOB,
+                    timestamp REAL NOT NULL,
+                    UNIQUE (epoch, id)
+                )
+            ''')
+            # Ключ собеседника и выведенный общий ключ, чтобы не повторять PBKDF2 при каждом запуске.
+            # Отпечатки обоих открытых ключей показывают, для какой пары ключ выведен
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS peers (
+                    peer_id BLOB PRIMARY KEY,
+                    public_key BLOB NOT NULL,
+                    fingerprint BLOB NOT NULL,
+                    own_fingerprint BLOB NOT NULL,
+                    shared_key BLOB NOT NULL
+                )
+            ''')
+
+    def close(self):
+        self.conn.close()
+
+    def _state(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def last_id(self):
+        return self._state('last_id', 0)
+
+    def epoch(self):
+        # Хранилище сервера, выдавшее last_id, или None, если сервер его не сообщал
+        return self._state('epoch')
+
+    def set_epoch(self, epoch, last_id=None):
+        # Курсор другого хранилища ничего не значит: при смене epoch он сбрасывается вместе с ней
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('epoch', ?)", (epoch,))
+            if last_id is not None:
+                self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('last_id', ?)", (last_id,))
+
+    def save_messages(self, messages, last_id):
+        # История и курсор пишутся одной транзакцией, чтобы после сбоя не было пропусков
+        with self.conn:
+            epoch = self._state('epoch', '')
+            self.conn.executemany('''
+                INSERT OR IGNORE INTO history (epoch, id, sender_id, sender_name, text, encrypted_message, timestamp)
+                VALUES (:epoch, :id, :sender_id, :sender_name, :text, :encrypted_message, :timestamp)
+            ''', [dict(msg, epoch=epoch) for msg in messages])
+            self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('last_id', ?)", (last_id,))
+
+    def peer_key(self, peer_id):
+        # (public_key, fingerprint, own_fingerprint, shared_key) или None
+        return self.conn.execute('''
+            SELECT public_key, fingerprint, own_fingerprint, shared_key FROM peers WHERE peer_id = ?
+        ''', (peer_id,)).fetchone()
+
+    def save_peer_key(self, peer_id, public_key, fingerprint, own_fingerprint, shared_key):
+        with self.conn:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO peers (peer_id, public_key, fingerprint, own_fingerprint, shared_key)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (peer_id, public_key, fingerprint, own_fingerprint, shared_key))
+
+    def recent(self, limit=SCROLLBACK):
+        cursor = self.conn.execute('''
+            SELECT id, sender_name, text, timestamp FROM (
+                SELECT * FROM history ORDER BY seq DESC LIMIT ?
+            ) ORDER BY seq ASC
+        ''', (limit,))
+        return [
+            {'id': row[0], 'sender_name': row[1], 'text': row[2], 'timestamp': row[3]}
+            for row in cursor
+        ]
@@ -0,0 +1,36 @@
+import json
+import os
+import random
+import secrets
+import time
+
+# Доля отправляемых сообщений с трассировкой (0 - выключено) и файл для этапов (JSON Lines)
+TRACE_SAMPLE = float(os.environ.get('CHAT_TRACE_SAMPLE', 0))
+TRACE_FILE = os.environ.get('CHAT_TRACE_FILE', 'chat_trace.jsonl')
+
+
+def tracing_enabled():
+    return TRACE_SAMPLE > 0
+
+
+def start_trace():
+    # Новая трассировка для сообщения, попавшего в выборку, иначе None
+    if not tracing_enabled() or random.random() >= TRACE_SAMPLE:
+        return None
+    return {'id': secrets.token_hex(8), 'stages': {'client_send': time.time()}}
+
+
+def trace_stage(trace, name):
+    if trace is not None:
+        trace['stages'][name] = time.time()
+
+
+def dump_trace(trace, side, **stages):
+    # Отправитель и получатель пишут свои половины, trace_report.py склеивает их по id.
+    # Трассировку получателя присылает собеседник: испорченная пропускается, а не прерывает приём
+    try:
+        record = json.dumps({'id': trace['id'], 'side': side, 'stages': dict(trace['stages'], **stages)})
+        with open(TRACE_FILE, 'a') as f:
+            f.write(record + '\n')
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        print(f"Trace skipped: {str(e)}")
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import tempfile
+
+from shared.protocols import (
+    encrypt_file_header, encrypt_file_chunk, decrypt_file_chunk,
+    FILE_CHUNK_SIZE, FILE_HEADER_SIZE, CHUNK_HEADER, MAX_CHUNK_DATA
+)
+
+
+async def encrypted_chunks(path, key, executor=None):
+    # Файл читается и шифруется по одному чанку в пуле потоков, поэтому
+    # память не зависит от размера файла. Чтение на чанк вперёд нужно, чтобы пометить последний
+    loop = asyncio.get_running_loop()
+    header = encrypt_file_header()
+    yield header
+
+    f = await loop.run_in_executor(executor, open, path, 'rb')
+    try:
+        index = 0
+        chunk = await loop.run_in_executor(executor, f.read, FILE_CHUNK_SIZE)
+        while True:
+            next_chunk = await loop.run_in_executor(executor, f.read, FILE_CHUNK_SIZE)
+            final = not next_chunk
+            yield await loop.run_in_executor(executor, encrypt_file_chunk, key, header, index, chunk, final)
+            if final:
+                break
+            chunk = next_chunk
+            index += 1
+    finally:
+        f.close()
+
+
+async def upload_file(session, base_url, sender_id, recipient_id, key, path, executor=None):
+    url = f"{base_url}/file?sender_id={sender_id.hex()}&recipient_id={recipient_id.hex()}"
+    async with session.post(url, data=encrypted_chunks(path, key, executor)) as resp:
+        if resp.status != 200:
+            raise ValueError(f"Upload failed ({resp.status}): {await resp.text()}")
+        return (await resp.json())['file_id']
+
+
+def reserve_path(path):
+    # Имя файла предлагает собеседник: существующие файлы (в том числе ключ и база клиента)
+    # не перезаписываются, вместо этого занимается свободное имя "name (N).ext"
+    base, ext = os.path.splitext(path)
+    n = 0
+    while True:
+        candidate = f"{base} ({n}){ext}" if n else path
+        try:
+            open(candidate, 'xb').close()
+            return candidate
+        except FileExistsError:
+            n += 1
+
+
+async def download_file(session, base_url, user_id, sender_key, file_id, path, executor=None):
+    # sender_key(sender_id) - корутина, возвращающая общий ключ с отправителем файла,
+    # отправитель известен только из ответа сервера. Возвращает (путь, размер)
+    loop = asyncio.get_running_loop()
+    async with session.get(f"{base_url}/file/{file_id}?user_id={user_id.hex()}") as resp:
+        if resp.status != 200:
+            raise ValueError(f"Download failed ({resp.status}): {await resp.text()}")
+        key = await sender_key(bytes.fromhex(resp.headers['X-Sender-Id']))
+
+        header = await resp.content.readexactly(FILE_HEADER_SIZE)
+        # Временный файл создаётся заново под уникальным именем: чужой "<name>.part" не перезаписывается
+        # и при ошибке удаляется только то, что создал этот вызов
+        fd, part_path = tempfile.mkstemp(
+            suffix='.part', prefix=f"{os.path.basename(path)}.", dir=os.path.dirname(path) or '.'
+        )
+        f = os.fdopen(fd, 'wb')
+        try:
+            index = 0
+            size = 0
+            while True:
+                length, final = CHUNK_HEADER.unpack(await resp.content.readexactly(CHUNK_HEADER.size))
+                if length > MAX_CHUNK_DATA:
+                    # Длину присылает сервер: не буферизуем больше, чем бывает в настоящем чанке
+                    raise ValueError(f"Chunk {index} is too large ({length} bytes)")
+                data = await resp.content.readexactly(length)
+                chunk = await loop.run_in_executor(executor, decrypt_file_chunk, key, header, index, data, final)
+                await loop.run_in_executor(executor, f.write, chunk)
+                size += len(chunk)
+                if final:
+                    break
+                index += 1
+        except BaseException:
+            f.close()
+            os.unlink(part_path)
+            raise
+        f.close()
+    path = await loop.run_in_executor(executor, reserve_path, path)
+    os.replace(part_path, path)
+    return path, size
@@ -2,13 +2,15 @@ param(
     [Parameter(Mandatory=$true)]
     [string]$yourName,
 
-    [Parameter(Mandatory=$true)]
+    # Необязателен: собеседника можно выбрать в чате командой /to <peer_name>
     [string]$peerName,
 
-    [Parameter(Mandatory=$true)]
     [string]$serverUrl
 )
 
 # Установка PYTHONPATH и запуск клиента
 $env:PYTHONPATH = (Get-Item -Path ".\").FullName
-python .\client\client.py $yourName $peerName $serverUrl
\ No newline at end of file
+$clientArgs = @($yourName)
+if ($peerName) { $clientArgs += $peerName }
+if ($serverUrl) { $clientArgs += $serverUrl }
+python .\client\client.py @clientArgs
\ No newline at end of file
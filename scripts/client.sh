@@ -1,13 +1,10 @@
 #!/bin/bash
-if [ $# -lt 2 ]; then
-    echo "Usage: $0 <your_name> <peer_name> [server_url]"
+if [ $# -lt 1 ]; then
+    echo "Usage: $0 <your_name> [peer_name[,peer_name...]] [server_url]"
+    echo "Peers can also be chosen in the chat with /to <peer_name>"
     exit 1
 fi
 
-YOUR_NAME=$1
-PEER_NAME=$2
-SERVER_URL=$3
-
-echo "Starting chat client for $YOUR_NAME (talking to $PEER_NAME)..."
+echo "Starting chat client for $1..."
 cd client
-PYTHONPATH=.. python client.py "$YOUR_NAME" "$PEER_NAME" "$SERVER_URL"
\ No newline at end of file
+PYTHONPATH=.. python client.py "$@"
\ No newline at end of file
@@ -1,77 +1,631 @@
+import asyncio
+import secrets
 import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from contextlib import contextmanager
+
+from cache import LRUCache
+from metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS, timed
 
 BASE_DIR = Path(__file__).parent
 DATABASE_PATH = BASE_DIR / 'chat.db'
-LIMIT = 100
+LIMIT = 100  # Размер страницы по умолчанию
+MAX_PAGE_SIZE = 1000
+READERS = 4  # Количество соединений (и потоков) для чтения
+STATEMENT_CACHE = 128  # Размер кэша подготовленных выражений на соединение
+WRITE_BATCH_SIZE = 256  # Максимум сообщений в одной транзакции
+WRITE_BATCH_DELAY = 0.002  # Сколько ждать пополнения пачки, сек
+USER_CACHE_SIZE = 10000  # Сколько пользователей держать в памяти
+MAX_LOOKUP = 500  # Максимум пользователей в одном пакетном запросе
+MESSAGE_TTL = 30 * 24 * 3600  # Сколько хранить недоставленные сообщения, сек (0 - бессрочно)
+PURGE_BATCH = 1000  # Сколько строк удалять за одну транзакцию
+MIN_TIMESTAMP = 946684800  # 2000-01-01: меньшие timestamp - время цикла событий старых версий
+VACUUM_PAGES = 1000  # Сколько свободных страниц возвращать ОС за один проход
+SHARDS = 1  # Количество файлов с сообщениями (1 - сообщения в основной базе)
+
+
+class ShardCountMismatch(Exception):
+    """База создана с другим числом шардов: без rebalance.py сообщения получателей окажутся не там"""
+
+
+class WriteBatcher:
+    """Групповая запись: копит строки до max_size или max_delay и пишет их одной транзакцией"""
+
+    def __init__(self, write, max_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        self._write = write
+        # С пустыми пачками очередь никогда бы не опустела
+        self.max_size = max(1, max_size)
+        self.max_delay = max(0, max_delay)
+        self._pending = []
+        self._full = None
+        self._task = None
+
+    async def submit(self, row):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if self._task is None:
+            self._full = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        try:
+            while self._pending:
+                if len(self._pending) < self.max_size and self.max_delay > 0:
+                    try:
+                        await asyncio.wait_for(self._full.wait(), self.max_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                self._full.clear()
+
+                # Пока идёт коммит, новые строки копятся для следующей пачки
+                batch = self._pending[:self.max_size]
+                del self._pending[:self.max_size]
+                try:
+                    ids = await self._write([row for row, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, future), row_id in zip(batch, ids):
+                        if not future.done():
+                            future.set_result(row_id)
+        finally:
+            self._task = None
+
+
+class Connections:
+    """Один файл SQLite: поток-писатель с единственным соединением и пул читателей"""
+
+    def __init__(self, path, readers=READERS):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Запись в SQLite всё равно сериализуется, а чтения в WAL идут параллельно
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix='db-reader')
+
+    def connection(self):
+        # Каждый поток пула держит своё долгоживущее соединение,
+        # PRAGMA выполняются один раз при его создании
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=10,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE
+            )
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA cache_size = -10000')  # 10MB кэша
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def run_write(self, func, *args):
+        # Синхронный вызов в потоке-писателе, нужен при инициализации
+        return self._writer.submit(func, *args).result()
+
+    async def _run(self, executor, kind, func, args):
+        # Время замеряется в потоке, а в метрики пишется уже в цикле событий - без блокировок
+        submitted = time.perf_counter()
+        result, start, end = await asyncio.get_running_loop().run_in_executor(executor, timed, func, args)
+        DB_WAIT_SECONDS.observe(start - submitted, kind)
+        DB_QUERY_SECONDS.observe(end - start, kind, func.__name__.lstrip('_'))
+        return result
+
+    async def read(self, func, *args):
+        return await self._run(self._readers, 'read', func, args)
+
+    async def write(self, func, *args):
+        return await self._run(self._writer, 'write', func, args)
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def init_storage(conn):
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        # Режим применяется к существующей базе только после VACUUM, для новой это мгновенно
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    conn.execute('PRAGMA journal_mode = WAL')
 
 
-class Database:
-    def __init__(self):
-        self._init_db()
+def new_epoch():
+    return secrets.token_hex(8)
+
+
+def init_users_schema(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id BLOB PRIMARY KEY,
+                public_key BLOB NOT NULL,
+                username TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                sender_id BLOB NOT NULL,
+                recipient_id BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                timestamp REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            )
+        ''')
+        # Epoch создаётся вместе с базой: новая база - новые id и новый epoch
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (new_epoch(),))
+
+
+def init_messages_schema(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_id BLOB NOT NULL,
+                recipient_id BLOB NOT NULL,
+                encrypted_message BLOB NOT NULL,
+                timestamp REAL NOT NULL,
+                FOREIGN KEY(sender_id) REFERENCES users(id),
+                FOREIGN KEY(recipient_id) REFERENCES users(id)
+            )
+        ''')
+        # Составной индекс точно покрывает WHERE recipient_id = ? AND id > ? ORDER BY id
+        conn.execute('DROP INDEX IF EXISTS idx_messages_recipient')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_recipient_id ON messages(recipient_id, id)')
+        # Общий шифротекст рассылки хранится один раз, строки messages ссылаются на него
+        # через blob_id, а в encrypted_message у них обёрнутый для получателя ключ
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data BLOB NOT NULL
+            )
+        ''')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'blob_id' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN blob_id INTEGER REFERENCES blobs(id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_blob ON messages(blob_id) WHERE blob_id IS NOT NULL')
+        # Этапы трассировки доставки (JSON) - только у сообщений, попавших в выборку клиента
+        if 'trace' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN trace TEXT')
+        # Просроченные ищутся по времени, а не по id: у строк, перенесённых rebalance.py,
+        # новые id при старом времени
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+        # Старые версии писали в timestamp время цикла событий (секунды с загрузки системы).
+        # Один раз при обновлении даём таким строкам время миграции, чтобы первая очистка
+        # по TTL не удалила все недоставленные сообщения
+        if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+            conn.execute('UPDATE messages SET timestamp = ? WHERE timestamp < ?', (time.time(), MIN_TIMESTAMP))
+            conn.execute('PRAGMA user_version = 1')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS acks (
+                recipient_id BLOB PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            )
+        ''')
+
+
+def read_shard_count(conn):
+    # Число шардов, с которым работает база, или None, если его ещё не записывали
+    row = conn.execute("SELECT value FROM meta WHERE key = 'shards'").fetchone()
+    return row[0] if row else None
+
+
+def write_shard_count(conn, shards):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('shards', ?)", (shards,))
+
+
+def shard_path(path, index, shards):
+    # При одном шарде сообщения лежат в основной базе, иначе - в chat.shard<N>.db рядом с ней
+    path = Path(path)
+    if shards <= 1:
+        return path
+    return path.with_name(f'{path.stem}.shard{index}{path.suffix}')
+
+
+def shard_index(recipient_id, shards):
+    # id пользователя - начало SHA256 от имени, так что остаток распределяется равномерно
+    return int.from_bytes(recipient_id[:8], 'big') % shards
+
+
+class MessageShard:
+    """Сообщения одного файла SQLite: групповая запись, выборка, подтверждения и очистка"""
+
+    def __init__(self, connections, batch_size=WRITE_BATCH_SIZE, batch_delay=WRITE_BATCH_DELAY):
+        self.connections = connections
+        self.connections.run_write(self._init_db)
+        self._batcher = WriteBatcher(
+            lambda rows: self.connections.write(self._add_messages, rows),
+            batch_size,
+            batch_delay
+        )
 
     def _init_db(self):
-        with self._get_cursor() as cursor:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id BLOB PRIMARY KEY,
-                    public_key BLOB NOT NULL,
-                    username TEXT NOT NULL
+        conn = self.connections.connection()
+        init_storage(conn)
+        init_messages_schema(conn)
+
+    def _add_messages(self, rows):
+        conn = self.connections.connection()
+        with conn:
+            conn.executemany('''
+                INSERT INTO messages (sender_id, recipient_id, encrypted_message, timestamp, trace)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            # Внутри одной транзакции AUTOINCREMENT выдаёт идущие подряд id
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def _add_messages_multi(self, sender_id, recipients, blob, timestamp):
+        # Вся рассылка - одна транзакция: общий blob один раз плюс по строке на получателя
+        conn = self.connections.connection()
+        with conn:
+            blob_id = None
+            if blob is not None:
+                blob_id = conn.execute('INSERT INTO blobs (data) VALUES (?)', (blob,)).lastrowid
+            conn.executemany('''
+                INSERT INTO messages (sender_id, recipient_id, encrypted_message, timestamp, blob_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (sender_id, recipient_id, encrypted_message, timestamp, blob_id)
+                for recipient_id, encrypted_message in recipients
+            ])
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(recipients) + 1, last_id + 1))
+
+    def _get_messages(self, recipient_id, last_id, limit):
+        cursor = self.connections.connection().execute('''
+            SELECT m.id, m.sender_id, m.encrypted_message, m.timestamp, b.data, m.trace
+            FROM messages m
+            LEFT JOIN blobs b ON b.id = m.blob_id
+            WHERE m.recipient_id = ? AND m.id > ?
+            ORDER BY m.id ASC
+            LIMIT ?
+        ''', (recipient_id, last_id, limit))
+        return cursor.fetchall()
+
+    def _ack(self, recipient_id, last_id):
+        # Подтвердить можно только уже существующие сообщения: иначе last_id из будущего
+        # (устаревший курсор клиента) удалил бы ещё не доставленные. Что подтверждает
+        # сам получатель, проверяет сервер по подписи
+        conn = self.connections.connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO acks (recipient_id, last_id)
+                VALUES (?1, min(?2, coalesce((SELECT max(id) FROM messages WHERE recipient_id = ?1), 0)))
+                ON CONFLICT(recipient_id) DO UPDATE SET last_id = max(last_id, excluded.last_id)
+            ''', (recipient_id, last_id))
+
+    def _purge_acked(self, batch_size):
+        conn = self.connections.connection()
+        with conn:
+            cursor = conn.execute('''
+                DELETE FROM messages WHERE id IN (
+                    SELECT m.id FROM acks a
+                    JOIN messages m ON m.recipient_id = a.recipient_id AND m.id <= a.last_id
+                    LIMIT ?
                 )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender_id BLOB NOT NULL,
-                    recipient_id BLOB NOT NULL,
-                    encrypted_message BLOB NOT NULL,
-                    timestamp REAL NOT NULL,
-                    FOREIGN KEY(sender_id) REFERENCES users(id),
-                    FOREIGN KEY(recipient_id) REFERENCES users(id)
+            ''', (batch_size,))
+            return cursor.rowcount
+
+    def _purge_expired(self, cutoff, batch_size):
+        # Индекс по timestamp: пачка просроченных строк находится без полного сканирования
+        conn = self.connections.connection()
+        with conn:
+            cursor = conn.execute('''
+                DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE timestamp < ? LIMIT ?)
+            ''', (cutoff, batch_size))
+            return cursor.rowcount
+
+    def _purge_blobs(self, batch_size):
+        conn = self.connections.connection()
+        with conn:
+            cursor = conn.execute('''
+                DELETE FROM blobs WHERE id IN (
+                    SELECT b.id FROM blobs b
+                    WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.blob_id = b.id)
+                    LIMIT ?
                 )
-            ''')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages(recipient_id)')
-
-    @contextmanager
-    def _get_cursor(self):
-        conn = sqlite3.connect(DATABASE_PATH, timeout=10)
-        conn.execute('PRAGMA journal_mode = WAL')
-        conn.execute('PRAGMA synchronous = NORMAL')
-        conn.execute('PRAGMA cache_size = -10000')  # 10MB кэша
+            ''', (batch_size,))
+            return cursor.rowcount
+
+    def _checkpoint(self):
+        conn = self.connections.connection()
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+    async def add_message(self, sender_id, recipient_id, encrypted_message, timestamp, trace=None):
+        return await self._batcher.submit((sender_id, recipient_id, encrypted_message, timestamp, trace))
+
+    async def add_messages_multi(self, sender_id, recipients, blob, timestamp):
+        return await self.connections.write(self._add_messages_multi, sender_id, recipients, blob, timestamp)
+
+    async def get_messages(self, recipient_id, last_id=0, limit=LIMIT):
+        return await self.connections.read(self._get_messages, recipient_id, last_id, limit)
+
+    async def ack(self, recipient_id, last_id):
+        await self.connections.write(self._ack, recipient_id, last_id)
+
+    async def compact(self, message_ttl=MESSAGE_TTL, batch_size=PURGE_BATCH):
+        # Каждая пачка удаляется отдельной короткой транзакцией в очереди писателя,
+        # так что вставки новых сообщений между ними не ждут
+        write = self.connections.write
+        deleted = 0
+        while True:
+            count = await write(self._purge_acked, batch_size)
+            deleted += count
+            if count < batch_size:
+                break
+        if message_ttl:
+            cutoff = time.time() - message_ttl
+            while True:
+                count = await write(self._purge_expired, cutoff, batch_size)
+                deleted += count
+                if count < batch_size:
+                    break
+        while await write(self._purge_blobs, batch_size) == batch_size:
+            pass
+        await write(self._checkpoint)
+        return deleted
+
+
+class Storage(ABC):
+    """Интерфейс хранилища, которым пользуется сервер. Database - реализация на SQLite.
+    Реализация, в которой не хватает метода, не создаётся"""
+
+    user_cache = None  # LRUCache пользователей, если хранилище его использует
+    evicted = 0  # Сколько недоставленных сообщений удалено из-за лимитов памяти (не по подтверждению или TTL)
+    # Идентификатор экземпляра хранилища: id сообщений сравнимы только при одном epoch.
+    # Клиент, увидев другой epoch, сбрасывает свой курсор
+    epoch = None
+
+    @abstractmethod
+    async def register_user(self, user_id, public_key, username):
+        ...
+
+    @abstractmethod
+    async def get_user(self, user_id):
+        # (public_key, username) или None
+        ...
+
+    @abstractmethod
+    async def get_users(self, user_ids):
+        # {user_id: (public_key, username)} только для найденных
+        ...
+
+    @abstractmethod
+    async def add_message(self, sender_id, recipient_id, encrypted_message, timestamp, trace=None):
+        # Возвращает id сообщения; id растут для каждого получателя
+        ...
+
+    @abstractmethod
+    async def add_messages_multi(self, sender_id, recipients, blob, timestamp):
+        # recipients - пары (recipient_id, encrypted_message); возвращает id в том же порядке
+        ...
+
+    @abstractmethod
+    async def get_messages(self, recipient_id, last_id=0, limit=LIMIT):
+        # Строки (id, sender_id, encrypted_message, timestamp, blob, trace) с id > last_id по возрастанию
+        ...
+
+    async def iter_messages(self, recipient_id, last_id=0, page_size=LIMIT):
+        # Постраничный обход по ключу: в памяти не больше одной страницы,
+        # соединение между страницами не удерживается
+        while True:
+            rows = await self.get_messages(recipient_id, last_id, page_size)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
+
+    @abstractmethod
+    async def ack(self, recipient_id, last_id):
+        ...
+
+    @abstractmethod
+    async def add_file(self, file_id, sender_id, recipient_id, size, timestamp):
+        ...
+
+    @abstractmethod
+    async def get_file(self, file_id):
+        # (sender_id, recipient_id, size, timestamp) или None
+        ...
+
+    @abstractmethod
+    async def purge_files(self, max_age):
+        # Возвращает id удалённых записей, чтобы вызывающий удалил сами файлы с диска
+        ...
+
+    @abstractmethod
+    async def compact(self, message_ttl=MESSAGE_TTL, batch_size=PURGE_BATCH):
+        # Удаляет подтверждённые и просроченные сообщения, возвращает их количество
+        ...
+
+    def close(self):
+        pass
+
+
+class Database(Storage):
+    def __init__(self, path=DATABASE_PATH, readers=READERS,
+                 batch_size=WRITE_BATCH_SIZE, batch_delay=WRITE_BATCH_DELAY,
+                 user_cache_size=USER_CACHE_SIZE, shards=SHARDS):
+        self.path = path
+        # Пользователи меняются только при регистрации, поэтому кэш не устаревает.
+        # Отсутствующих пользователей не кэшируем: они могут зарегистрироваться позже
+        self.user_cache = LRUCache(user_cache_size)
+        # Пользователи и файлы всегда в основной базе
+        self._main = Connections(path, readers)
         try:
-            yield conn.cursor()
-            conn.commit()
-        finally:
-            conn.close()
+            self._main.run_write(self._init_db, max(shards, 1))
+        except ShardCountMismatch:
+            self._main.close()
+            raise
+        # Сообщения можно разнести по нескольким файлам по хешу получателя:
+        # у каждого шарда свой писатель, и записи разных получателей не ждут друг друга
+        if shards <= 1:
+            self.shards = [MessageShard(self._main, batch_size, batch_delay)]
+        else:
+            self.shards = [
+                MessageShard(Connections(shard_path(path, i, shards), readers), batch_size, batch_delay)
+                for i in range(shards)
+            ]
+
+    def _init_db(self, shards):
+        conn = self._main.connection()
+        init_storage(conn)
+        init_users_schema(conn)
+        self.epoch = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        # Получатель ищется по остатку от числа шардов: с другим числом его сообщения не найдутся
+        stored = read_shard_count(conn)
+        if stored is None:
+            write_shard_count(conn, shards)
+        elif stored != shards:
+            raise ShardCountMismatch(
+                f'Сообщения в {self.path} разнесены на {stored} шард(ов), а сервер запущен с --shards {shards}. '
+                f'Остановите сервер и перенесите их: python rebalance.py --db {self.path} --from {stored} --to {shards}'
+            )
+
+    def shard(self, recipient_id):
+        return self.shards[shard_index(recipient_id, len(self.shards))]
+
+    def close(self):
+        for shard in self.shards:
+            if shard.connections is not self._main:
+                shard.connections.close()
+        self._main.close()
 
-    def register_user(self, user_id, public_key, username):
-        with self._get_cursor() as cursor:
-            cursor.execute('''
+    def _register_user(self, user_id, public_key, username):
+        conn = self._main.connection()
+        with conn:
+            conn.execute('''
                 INSERT OR IGNORE INTO users (id, public_key, username)
                 VALUES (?, ?, ?)
             ''', (user_id, public_key, username))
+            # INSERT OR IGNORE не перезаписывает существующего пользователя - кэшируем то, что в базе
+            return conn.execute('SELECT public_key, username FROM users WHERE id = ?', (user_id,)).fetchone()
+
+    def _get_user(self, user_id):
+        cursor = self._main.connection().execute('SELECT public_key, username FROM users WHERE id = ?', (user_id,))
+        return cursor.fetchone()
+
+    def _get_users(self, user_ids):
+        placeholders = ', '.join('?' * len(user_ids))
+        cursor = self._main.connection().execute(
+            f'SELECT id, public_key, username FROM users WHERE id IN ({placeholders})',
+            user_ids
+        )
+        return {row[0]: row[1:] for row in cursor}
+
+    def _add_file(self, file_id, sender_id, recipient_id, size, timestamp):
+        conn = self._main.connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO files (id, sender_id, recipient_id, size, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (file_id, sender_id, recipient_id, size, timestamp))
+
+    def _get_file(self, file_id):
+        cursor = self._main.connection().execute(
+            'SELECT sender_id, recipient_id, size, timestamp FROM files WHERE id = ?', (file_id,)
+        )
+        return cursor.fetchone()
+
+    def _purge_files(self, cutoff):
+        conn = self._main.connection()
+        with conn:
+            file_ids = [row[0] for row in conn.execute('SELECT id FROM files WHERE timestamp < ?', (cutoff,))]
+            conn.executemany('DELETE FROM files WHERE id = ?', [(file_id,) for file_id in file_ids])
+        return file_ids
+
+    async def register_user(self, user_id, public_key, username):
+        user = await self._main.write(self._register_user, user_id, public_key, username)
+        self.user_cache.put(user_id, user)
+
+    async def get_user(self, user_id):
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await self._main.read(self._get_user, user_id)
+            if user is not None:
+                self.user_cache.put(user_id, user)
+        return user
+
+    async def get_users(self, user_ids):
+        users = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.user_cache.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+        if missing:
+            found = await self._main.read(self._get_users, missing)
+            for user_id, user in found.items():
+                self.user_cache.put(user_id, user)
+            users.update(found)
+        return users
+
+    async def add_message(self, sender_id, recipient_id, encrypted_message, timestamp, trace=None):
+        return await self.shard(recipient_id).add_message(
+            sender_id, recipient_id, encrypted_message, timestamp, trace
+        )
+
+    async def add_messages_multi(self, sender_id, recipients, blob, timestamp):
+        # Рассылка пишется одной транзакцией в каждый затронутый шард, общий blob - по разу на шард
+        groups = {}
+        for position, recipient in enumerate(recipients):
+            groups.setdefault(self.shard(recipient[0]), []).append((position, recipient))
+        results = await asyncio.gather(*(
+            shard.add_messages_multi(sender_id, [recipient for _, recipient in group], blob, timestamp)
+            for shard, group in groups.items()
+        ))
+        ids = [None] * len(recipients)
+        for group, group_ids in zip(groups.values(), results):
+            for (position, _), row_id in zip(group, group_ids):
+                ids[position] = row_id
+        return ids
+
+    async def add_file(self, file_id, sender_id, recipient_id, size, timestamp):
+        await self._main.write(self._add_file, file_id, sender_id, recipient_id, size, timestamp)
+
+    async def get_file(self, file_id):
+        return await self._main.read(self._get_file, file_id)
+
+    async def purge_files(self, max_age):
+        return await self._main.write(self._purge_files, time.time() - max_age)
+
+    async def get_messages(self, recipient_id, last_id=0, limit=LIMIT):
+        return await self.shard(recipient_id).get_messages(recipient_id, last_id, limit)
+
+    async def ack(self, recipient_id, last_id):
+        await self.shard(recipient_id).ack(recipient_id, last_id)
 
-    def get_user(self, user_id):
-        with self._get_cursor() as cursor:
-            cursor.execute('SELECT public_key, username FROM users WHERE id = ?', (user_id,))
-            return cursor.fetchone()
-
-    def add_message(self, sender_id, recipient_id, encrypted_message, timestamp):
-        with self._get_cursor() as cursor:
-            cursor.execute('''
-                INSERT INTO messages (sender_id, recipient_id, encrypted_message, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (sender_id, recipient_id, encrypted_message, timestamp))
-            return cursor.lastrowid
-
-    def get_messages(self, recipient_id, last_id=0):
-        with self._get_cursor() as cursor:
-            cursor.execute('''
-                SELECT id, sender_id, encrypted_message, timestamp
-                FROM messages
-                WHERE recipient_id = ? AND id > ?
-                ORDER BY id ASC
-                LIMIT ?
-            ''', (recipient_id, last_id, LIMIT))
-            return cursor.fetchall()
+    async def compact(self, message_ttl=MESSAGE_TTL, batch_size=PURGE_BATCH):
+        deleted = 0
+        for shard in self.shards:
+            deleted += await shard.compact(message_ttl, batch_size)
+        return deleted
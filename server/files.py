@@ -0,0 +1,54 @@
+import asyncio
+import os
+import secrets
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent
+FILES_DIR = BASE_DIR / 'files'
+MAX_FILE_SIZE = 8 * 1024 ** 3  # 8 ГБ
+WRITE_CHUNK_SIZE = 256 * 1024
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class FileStore:
+    """Зашифрованные файлы лежат на диске вне SQLite, в базе - только их описание"""
+
+    def __init__(self, path=FILES_DIR, max_size=MAX_FILE_SIZE):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def file_path(self, file_id):
+        return self.path / file_id
+
+    async def save(self, content):
+        # Пишем поток частями по мере поступления: в памяти не больше одного куска.
+        # Файл появляется под своим id только после полной записи
+        file_id = secrets.token_hex(16)
+        part_path = self.path / f"{file_id}.part"
+        loop = asyncio.get_running_loop()
+        size = 0
+        f = await loop.run_in_executor(None, open, part_path, 'wb')
+        try:
+            async for chunk in content.iter_chunked(WRITE_CHUNK_SIZE):
+                size += len(chunk)
+                if size > self.max_size:
+                    raise FileTooLarge(f"File exceeds {self.max_size} bytes")
+                await loop.run_in_executor(None, f.write, chunk)
+        except BaseException:
+            await loop.run_in_executor(None, f.close)
+            await loop.run_in_executor(None, part_path.unlink)
+            raise
+        await loop.run_in_executor(None, f.close)
+        await loop.run_in_executor(None, os.replace, part_path, self.file_path(file_id))
+        return file_id, size
+
+    async def remove(self, file_ids):
+        def unlink():
+            for file_id in file_ids:
+                self.file_path(file_id).unlink(missing_ok=True)
+
+        await asyncio.get_running_loop().run_in_executor(None, unlink)
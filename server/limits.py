@@ -0,0 +1,63 @@
+import time
+from contextlib import contextmanager
+
+from cache import LRUCache
+
+MAX_KEYS = 100000  # Сколько ключей (пользователей, адресов) помнит один ограничитель
+# Лимиты по умолчанию: запросов в секунду и допустимый всплеск.
+# Пользовательские лимиты считаются на пару (пользователь, адрес): id в запросе не подтверждён
+SEND_RATE, SEND_BURST = 20, 50  # /message, /message/multi на отправителя
+POLL_RATE, POLL_BURST = 10, 30  # /messages, /messages/stream на получателя
+REGISTER_RATE, REGISTER_BURST = 0.5, 5  # /register на адрес
+IP_RATE, IP_BURST = 100, 200  # Все ограничиваемые маршруты вместе на адрес
+MAX_IN_FLIGHT = 1000  # Одновременно обрабатываемых запросов, без ждущих long-poll
+OVERLOAD_RETRY_AFTER = 1  # Retry-After для 503, сек
+
+
+class RateLimiter:
+    """Token bucket на ключ: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate, burst, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # Давно не встречавшийся ключ вытесняется и начинает с полным ведром
+        self._buckets = LRUCache(max_keys)
+
+    def take(self, key):
+        # 0, если запрос разрешён, иначе через сколько секунд появится токен
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= 1:
+            self._buckets.put(key, (tokens - 1, now))
+            return 0
+        self._buckets.put(key, (tokens, now))
+        return (1 - tokens) / self.rate
+
+
+class Admission:
+    """Ограничение числа одновременно обрабатываемых запросов"""
+
+    def __init__(self, limit=MAX_IN_FLIGHT):
+        self.limit = limit
+        self.active = 0
+
+    def try_enter(self):
+        if self.limit and self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def leave(self):
+        self.active -= 1
+
+    @contextmanager
+    def parked(self):
+        # Запрос, ждущий новых сообщений, не нагружает сервер и не занимает место в лимите
+        self.active -= 1
+        try:
+            yield
+        finally:
+            self.active += 1
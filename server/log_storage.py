@@ -0,0 +1,391 @@
+import asyncio
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from database import (
+    Storage, WriteBatcher, BASE_DIR, LIMIT, READERS, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, MESSAGE_TTL, PURGE_BATCH,
+    new_epoch
+)
+
+LOG_DIR = BASE_DIR / 'chat_log'
+SEGMENT_SIZE = 64 * 1024 ** 2  # Размер сегмента, после которого начинается новый, байт
+LOCATION_BITS = 40  # Смещение в сегменте занимает младшие биты адреса записи
+
+# Запись сегмента: crc32(вид + тело), длина тела, вид; далее тело
+RECORD_HEADER = struct.Struct('>IIB')
+RECORD_MESSAGE = 1
+RECORD_BLOB = 2
+RECORD_START = 3  # Первая запись сегмента: следующий id, чтобы id не начались заново после очистки
+START_RECORD = struct.Struct('>Q')
+# Тело сообщения: id, timestamp, sender_id, recipient_id, смещение blob, длины шифротекста и трассировки
+MESSAGE_RECORD = struct.Struct('>Qd16s16sQII')
+NO_BLOB = 2 ** 64 - 1
+
+
+def segment_name(number):
+    return f'segment-{number:08d}.log'
+
+
+def encode_record(kind, body):
+    crc = zlib.crc32(body, zlib.crc32(bytes((kind,))))
+    return RECORD_HEADER.pack(crc, len(body), kind) + body
+
+
+def read_record(f, offset):
+    # Запись по смещению или None, если она неполная или повреждена (оборванная запись в конце)
+    header = os.pread(f.fileno(), RECORD_HEADER.size, offset)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    crc, length, kind = RECORD_HEADER.unpack(header)
+    body = os.pread(f.fileno(), length, offset + RECORD_HEADER.size)
+    if len(body) < length or zlib.crc32(body, zlib.crc32(bytes((kind,)))) != crc:
+        return None
+    return kind, body
+
+
+def decode_message(body):
+    row_id, timestamp, sender_id, recipient_id, blob_offset, length, trace_len = MESSAGE_RECORD.unpack_from(body)
+    start = MESSAGE_RECORD.size
+    encrypted_message = body[start:start + length]
+    trace = body[start + length:start + length + trace_len].decode() if trace_len else None
+    return row_id, timestamp, sender_id, recipient_id, blob_offset, encrypted_message, trace
+
+
+class Segment:
+    """Описание сегмента для индекса и очистки: сами записи лежат только в файле"""
+
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.count = 0
+        self.last_timestamp = 0
+        self.recipients = {}  # recipient_id -> максимальный id сообщения в сегменте
+
+
+class LogStorage(Storage):
+    """Сообщения в журнале сегментов только на дозапись с индексом смещений по получателю.
+    Пользователи, описания файлов и подтверждения - в журнале meta.log, восстанавливаются при старте"""
+
+    def __init__(self, path=LOG_DIR, readers=READERS, batch_size=WRITE_BATCH_SIZE,
+                 batch_delay=WRITE_BATCH_DELAY, segment_size=SEGMENT_SIZE, fsync=False):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.users = {}
+        self.files = {}
+        self.acks = {}
+        self.segments = {}
+        # Индекс: recipient_id -> (id сообщений, адреса записей) по возрастанию id.
+        # Меняется в потоке-писателе, читается в цикле событий - под блокировкой
+        self.index = {}
+        self._lock = threading.Lock()
+        self._meta_records = 0
+        self._next_id = 1
+        self._active = None
+        self._active_file = None
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='log-writer')
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix='log-reader')
+        self._writer.submit(self._recover).result()
+        self._batcher = WriteBatcher(self._write_batch, batch_size, batch_delay)
+
+    def _recover(self):
+        # Метаданные - повтор журнала, сообщения - проход по всем сегментам с построением индекса
+        meta_path = self.path / 'meta.log'
+        if meta_path.exists():
+            offset = 0
+            with open(meta_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Оборванная последняя строка
+                    try:
+                        self._apply_meta(json.loads(line))
+                    except ValueError:
+                        break
+                    offset += len(line)
+                    self._meta_records += 1
+            if offset < meta_path.stat().st_size:
+                # Как и у сегментов, хвост после сбоя отрезаем: иначе новые записи допишутся
+                # за ним и при следующем запуске будут потеряны вместе с ним
+                os.truncate(meta_path, offset)
+        self._meta_file = open(meta_path, 'a')
+        if self.epoch is None:
+            self.epoch = new_epoch()
+            self._append_meta([{'type': 'epoch', 'value': self.epoch}])
+
+        numbers = sorted(int(p.stem.split('-')[1]) for p in self.path.glob('segment-*.log'))
+        for number in numbers:
+            segment = self.segments[number] = Segment(number, self.path / segment_name(number))
+            with open(segment.path, 'rb') as f:
+                offset = 0
+                while True:
+                    record = read_record(f, offset)
+                    if record is None:
+                        break
+                    kind, body = record
+                    if kind == RECORD_MESSAGE:
+                        row_id, timestamp, _, recipient_id = decode_message(body)[:4]
+                        self._index_message(segment, recipient_id, row_id, timestamp, offset)
+                        self._next_id = max(self._next_id, row_id + 1)
+                    elif kind == RECORD_START:
+                        self._next_id = max(self._next_id, START_RECORD.unpack(body)[0])
+                    offset += RECORD_HEADER.size + len(body)
+            if offset < segment.path.stat().st_size:
+                # Хвост после сбоя при записи отбрасываем
+                os.truncate(segment.path, offset)
+        self._open_segment(numbers[-1] if numbers else 0)
+
+    def _apply_meta(self, record):
+        kind = record['type']
+        if kind == 'user':
+            self.users.setdefault(bytes.fromhex(record['id']), (bytes.fromhex(record['key']), record['name']))
+        elif kind == 'file':
+            self.files[record['id']] = (
+                bytes.fromhex(record['sender']), bytes.fromhex(record['recipient']), record['size'], record['time']
+            )
+        elif kind == 'unfile':
+            self.files.pop(record['id'], None)
+        elif kind == 'ack':
+            recipient_id = bytes.fromhex(record['id'])
+            self.acks[recipient_id] = max(self.acks.get(recipient_id, 0), record['last_id'])
+        elif kind == 'epoch':
+            self.epoch = record['value']
+
+    def _open_segment(self, number):
+        if self._active_file is not None:
+            self._active_file.close()
+        path = self.path / segment_name(number)
+        self._active_file = open(path, 'ab')
+        if self._active_file.tell() == 0:
+            self._active_file.write(encode_record(RECORD_START, START_RECORD.pack(self._next_id)))
+            self._active_file.flush()
+        # Очистка не трогает активный сегмент, поэтому он меняется под той же блокировкой
+        with self._lock:
+            self._active = self.segments.setdefault(number, Segment(number, path))
+
+    def _index_message(self, segment, recipient_id, row_id, timestamp, offset):
+        entry = self.index.get(recipient_id)
+        if entry is None:
+            entry = self.index[recipient_id] = (array('Q'), array('Q'))
+        entry[0].append(row_id)
+        entry[1].append(segment.number << LOCATION_BITS | offset)
+        segment.count += 1
+        segment.last_timestamp = max(segment.last_timestamp, timestamp)
+        segment.recipients[recipient_id] = row_id
+
+    def _append_messages(self, rows, blob=None):
+        # rows - (sender_id, recipient_id, encrypted_message, timestamp, trace). Пачка целиком
+        # попадает в один сегмент, так что общий blob рассылки всегда рядом со своими строками
+        if self._active_file.tell() >= self.segment_size:
+            self._open_segment(self._active.number + 1)
+        f = self._active_file
+        offset = f.tell()
+        blob_offset = NO_BLOB
+        if blob is not None:
+            blob_offset = offset
+            record = encode_record(RECORD_BLOB, blob)
+            f.write(record)
+            offset += len(record)
+
+        written = []
+        for sender_id, recipient_id, encrypted_message, timestamp, trace in rows:
+            trace = trace.encode() if trace is not None else b''
+            row_id = self._next_id
+            self._next_id += 1
+            record = encode_record(RECORD_MESSAGE, MESSAGE_RECORD.pack(
+                row_id, timestamp, sender_id, recipient_id, blob_offset, len(encrypted_message), len(trace)
+            ) + encrypted_message + trace)
+            f.write(record)
+            written.append((recipient_id, row_id, timestamp, offset))
+            offset += len(record)
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+        # Читатели видят строку только после того, как она записана в файл
+        with self._lock:
+            for recipient_id, row_id, timestamp, offset in written:
+                self._index_message(self._active, recipient_id, row_id, timestamp, offset)
+        return [row_id for _, row_id, _, _ in written]
+
+    def _append_meta(self, records):
+        for record in records:
+            self._meta_file.write(json.dumps(record) + '\n')
+        self._meta_file.flush()
+        if self.fsync:
+            os.fsync(self._meta_file.fileno())
+        self._meta_records += len(records)
+
+    def _rewrite_meta(self, records):
+        # Снимок состояния вместо накопившейся истории подтверждений и удалённых файлов
+        tmp_path = self.path / 'meta.log.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._meta_file.close()
+        os.replace(tmp_path, self.path / 'meta.log')
+        self._meta_file = open(self.path / 'meta.log', 'a')
+        self._meta_records = len(records)
+
+    def _read_rows(self, locations):
+        rows = []
+        files = {}
+        try:
+            for location in locations:
+                number, offset = location >> LOCATION_BITS, location & ((1 << LOCATION_BITS) - 1)
+                f = files.get(number)
+                if f is None:
+                    try:
+                        f = files[number] = open(self.path / segment_name(number), 'rb')
+                    except FileNotFoundError:
+                        continue  # Сегмент удалён очисткой, пока шёл запрос
+                record = read_record(f, offset)
+                if record is None:
+                    continue
+                row_id, timestamp, sender_id, _, blob_offset, encrypted_message, trace = decode_message(record[1])
+                blob = None
+                if blob_offset != NO_BLOB:
+                    blob_record = read_record(f, blob_offset)
+                    blob = blob_record[1] if blob_record is not None else None
+                rows.append((row_id, sender_id, encrypted_message, timestamp, blob, trace))
+        finally:
+            for f in files.values():
+                f.close()
+        return rows
+
+    async def _write(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def _write_batch(self, rows):
+        return await self._write(self._append_messages, rows)
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown()
+        self._active_file.close()
+        self._meta_file.close()
+
+    async def register_user(self, user_id, public_key, username):
+        # Состояние в памяти меняется до записи в журнал, чтобы снимок meta.log ничего не потерял
+        if user_id in self.users:
+            return
+        self.users[user_id] = (public_key, username)
+        await self._write(self._append_meta, [
+            {'type': 'user', 'id': user_id.hex(), 'key': public_key.hex(), 'name': username}
+        ])
+
+    async def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def get_users(self, user_ids):
+        return {user_id: self.users[user_id] for user_id in user_ids if user_id in self.users}
+
+    async def add_message(self, sender_id, recipient_id, encrypted_message, timestamp, trace=None):
+        return await self._batcher.submit((sender_id, recipient_id, encrypted_message, timestamp, trace))
+
+    async def add_messages_multi(self, sender_id, recipients, blob, timestamp):
+        return await self._write(self._append_messages, [
+            (sender_id, recipient_id, encrypted_message, timestamp, None)
+            for recipient_id, encrypted_message in recipients
+        ], blob)
+
+    async def get_messages(self, recipient_id, last_id=0, limit=LIMIT):
+        with self._lock:
+            entry = self.index.get(recipient_id)
+            if entry is None:
+                return []
+            start = bisect_right(entry[0], last_id)
+            locations = entry[1][start:start + limit]
+        if not locations:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read_rows, locations)
+
+    async def ack(self, recipient_id, last_id):
+        # Подтверждение не дальше последнего сообщения получателя, иначе очистка
+        # удалила бы ещё не доставленные
+        with self._lock:
+            entry = self.index.get(recipient_id)
+            last_id = min(last_id, entry[0][-1] if entry else 0)
+        if last_id <= self.acks.get(recipient_id, 0):
+            return
+        self.acks[recipient_id] = last_id
+        await self._write(self._append_meta, [{'type': 'ack', 'id': recipient_id.hex(), 'last_id': last_id}])
+
+    async def add_file(self, file_id, sender_id, recipient_id, size, timestamp):
+        self.files[file_id] = (sender_id, recipient_id, size, timestamp)
+        await self._write(self._append_meta, [{
+            'type': 'file', 'id': file_id, 'sender': sender_id.hex(), 'recipient': recipient_id.hex(),
+            'size': size, 'time': timestamp
+        }])
+
+    async def get_file(self, file_id):
+        return self.files.get(file_id)
+
+    async def purge_files(self, max_age):
+        cutoff = time.time() - max_age
+        file_ids = [file_id for file_id, info in self.files.items() if info[3] < cutoff]
+        for file_id in file_ids:
+            del self.files[file_id]
+        if file_ids:
+            await self._write(self._append_meta, [{'type': 'unfile', 'id': file_id} for file_id in file_ids])
+        return file_ids
+
+    def _drop_segment(self, segment):
+        # Строки сегмента у каждого получателя идут подряд: вырезаем их диапазон из индекса
+        for recipient_id in segment.recipients:
+            ids, locations = self.index[recipient_id]
+            start = bisect_left(locations, segment.number << LOCATION_BITS)
+            end = bisect_left(locations, (segment.number + 1) << LOCATION_BITS)
+            del ids[start:end]
+            del locations[start:end]
+            if not ids:
+                del self.index[recipient_id]
+        del self.segments[segment.number]
+
+    async def compact(self, message_ttl=MESSAGE_TTL, batch_size=PURGE_BATCH):
+        # Журнал не переписывается: удаляются целые закрытые сегменты, в которых
+        # все сообщения подтверждены получателями или просрочены
+        cutoff = time.time() - message_ttl if message_ttl else 0
+        deleted = 0
+        dropped = []
+        with self._lock:
+            for segment in list(self.segments.values()):
+                if segment is self._active:
+                    continue
+                if segment.last_timestamp < cutoff or all(
+                    self.acks.get(recipient_id, 0) >= max_id for recipient_id, max_id in segment.recipients.items()
+                ):
+                    self._drop_segment(segment)
+                    dropped.append(segment)
+                    deleted += segment.count
+        for segment in dropped:
+            segment.path.unlink(missing_ok=True)
+
+        # Подтверждения получателей, у которых не осталось сообщений, больше не нужны
+        for recipient_id in [recipient_id for recipient_id in self.acks if recipient_id not in self.index]:
+            del self.acks[recipient_id]
+        live = 1 + len(self.users) + len(self.files) + len(self.acks)
+        if self._meta_records > 2 * live + batch_size:
+            records = [{'type': 'epoch', 'value': self.epoch}] + [
+                {'type': 'user', 'id': user_id.hex(), 'key': public_key.hex(), 'name': username}
+                for user_id, (public_key, username) in self.users.items()
+            ] + [
+                {'type': 'file', 'id': file_id, 'sender': sender_id.hex(), 'recipient': recipient_id.hex(),
+                 'size': size, 'time': timestamp}
+                for file_id, (sender_id, recipient_id, size, timestamp) in self.files.items()
+            ] + [
+                {'type': 'ack', 'id': recipient_id.hex(), 'last_id': last_id}
+                for recipient_id, last_id in self.acks.items()
+            ]
+            await self._write(self._rewrite_meta, records)
+        return deleted
@@ -0,0 +1,148 @@
+import heapq
+import time
+from collections import deque
+
+from database import Storage, LIMIT, MESSAGE_TTL, PURGE_BATCH, new_epoch
+
+MEMORY_BUDGET = 256 * 1024 ** 2  # Общий объём сообщений в памяти, байт
+RING_SIZE = 10000  # Максимум недоставленных сообщений на получателя
+ROW_OVERHEAD = 200  # Примерный размер кортежа и объектов bytes строки сверх данных, байт
+
+
+def row_size(row):
+    # Общий blob рассылки учитывается в каждой строке - оценка объёма с запасом
+    return ROW_OVERHEAD + len(row[2]) + len(row[4] or b'') + len(row[5] or '')
+
+
+class MemoryStorage(Storage):
+    """Хранилище без диска: кольцевой буфер сообщений на получателя и общий лимит памяти"""
+
+    def __init__(self, budget=MEMORY_BUDGET, ring_size=RING_SIZE):
+        self.budget = budget
+        self.ring_size = ring_size
+        self.users = {}
+        self.files = {}
+        self.rings = {}  # recipient_id -> deque строк по возрастанию id
+        # Все строки в порядке добавления - для вытеснения самых старых при нехватке памяти.
+        # Строки, уже удалённые из колец, вычищаются из него лениво
+        self.order = deque()
+        self.stale = 0
+        self.size = 0
+        # Сообщения не переживают перезапуск, а курсоры клиентов переживают: id начинаются
+        # с текущего времени в микросекундах, чтобы после перезапуска не идти назад
+        self.next_id = time.time_ns() // 1000
+        # Сообщения прежнего процесса потеряны - клиентам нужно начать с начала
+        self.epoch = new_epoch()
+        self.evicted = 0  # Вытесненные из-за --ring-size и --memory-budget, видны в /metrics
+
+    def _remove_front(self, ring):
+        row = ring.popleft()
+        self.size -= row_size(row)
+        self.stale += 1
+        return row
+
+    def _add(self, row, recipient_id):
+        ring = self.rings.get(recipient_id)
+        if ring is None:
+            ring = self.rings[recipient_id] = deque()
+        if len(ring) >= self.ring_size:
+            self._remove_front(ring)
+            self.evicted += 1
+        ring.append(row)
+        self.order.append((recipient_id, row))
+        self.size += row_size(row)
+
+    def _evict_oldest(self):
+        recipient_id, row = self.order.popleft()
+        ring = self.rings.get(recipient_id)
+        if ring and ring[0] is row:
+            self._remove_front(ring)
+            self.stale -= 1
+            if not ring:
+                del self.rings[recipient_id]
+            return True
+        self.stale -= 1
+        return False
+
+    def _trim(self):
+        while self.size > self.budget and self.order:
+            if self._evict_oldest():
+                self.evicted += 1
+        if self.stale > len(self.order) // 2 + 1000:
+            # Слишком много удалённых строк в общей очереди - пересобираем её из колец
+            self.order = deque(heapq.merge(
+                *([(recipient_id, row) for row in ring] for recipient_id, ring in self.rings.items()),
+                key=lambda item: item[1][0]
+            ))
+            self.stale = 0
+
+    async def register_user(self, user_id, public_key, username):
+        self.users.setdefault(user_id, (public_key, username))
+
+    async def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def get_users(self, user_ids):
+        return {user_id: self.users[user_id] for user_id in user_ids if user_id in self.users}
+
+    async def add_message(self, sender_id, recipient_id, encrypted_message, timestamp, trace=None):
+        row_id = self.next_id
+        self.next_id += 1
+        self._add((row_id, sender_id, encrypted_message, timestamp, None, trace), recipient_id)
+        self._trim()
+        return row_id
+
+    async def add_messages_multi(self, sender_id, recipients, blob, timestamp):
+        ids = []
+        for recipient_id, encrypted_message in recipients:
+            ids.append(self.next_id)
+            self._add((self.next_id, sender_id, encrypted_message, timestamp, blob, None), recipient_id)
+            self.next_id += 1
+        self._trim()
+        return ids
+
+    async def get_messages(self, recipient_id, last_id=0, limit=LIMIT):
+        ring = self.rings.get(recipient_id)
+        if not ring:
+            return []
+        # В кольце обычно только неподтверждённые строки, поэтому проход короткий
+        rows = []
+        for row in ring:
+            if row[0] > last_id:
+                rows.append(row)
+                if len(rows) >= limit:
+                    break
+        return rows
+
+    async def ack(self, recipient_id, last_id):
+        # Подтверждённое сразу освобождает память
+        ring = self.rings.get(recipient_id)
+        while ring and ring[0][0] <= last_id:
+            self._remove_front(ring)
+        if ring is not None and not ring:
+            del self.rings[recipient_id]
+        self._trim()
+
+    async def add_file(self, file_id, sender_id, recipient_id, size, timestamp):
+        self.files[file_id] = (sender_id, recipient_id, size, timestamp)
+
+    async def get_file(self, file_id):
+        return self.files.get(file_id)
+
+    async def purge_files(self, max_age):
+        cutoff = time.time() - max_age
+        file_ids = [file_id for file_id, info in self.files.items() if info[3] < cutoff]
+        for file_id in file_ids:
+            del self.files[file_id]
+        return file_ids
+
+    async def compact(self, message_ttl=MESSAGE_TTL, batch_size=PURGE_BATCH):
+        # Подтверждённые уже удалены в ack, здесь - только просроченные, с начала общей очереди
+        deleted = 0
+        if message_ttl:
+            cutoff = time.time() - message_ttl
+            while self.order and self.order[0][1][3] < cutoff:
+                if self._evict_oldest():
+                    deleted += 1
+        self._trim()
+        return deleted
@@ -0,0 +1,158 @@
+import asyncio
+import time
+from bisect import bisect_left
+
+# Границы гистограмм, сек: HTTP-запросы (с учётом long-poll) и отдельные запросы к SQLite
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+LAG_INTERVAL = 0.5  # Период замера задержки цикла событий, сек
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), func=None):
+        # func - значение без меток, вычисляемое при выдаче (например, счётчики кэша)
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+
+    def samples(self, const_labels):
+        names = tuple(const_labels) + self.labels
+        const = tuple(const_labels.values())
+        if self.func is not None:
+            yield self.name, format_labels(names, const), self.func()
+            return
+        for values, value in self._values.items():
+            yield self.name, format_labels(names, const + values), value
+
+    def render(self, const_labels):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples(const_labels):
+            lines.append(f'{name}{labels} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # Храним попадания в каждый интервал, накопительные суммы считаются только при выдаче
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def samples(self, const_labels):
+        names = tuple(const_labels) + self.labels + ('le',)
+        const = tuple(const_labels.values())
+        for values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', format_labels(names, const + values + (format_value(bound),)), cumulative
+            yield f'{self.name}_sum', format_labels(names[:-1], const + values), total
+            yield f'{self.name}_count', format_labels(names[:-1], const + values), cumulative
+
+
+class Registry:
+    """Метрики процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics = []
+        # Метки, добавляемые ко всем метрикам (например, номер воркера)
+        self.const_labels = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(self.const_labels))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'chat_http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status')
+))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency, long-poll wait included', ('method', 'route')
+))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    'chat_http_requests_in_flight', 'HTTP requests being processed'
+))
+HTTP_IN_FLIGHT.set(0)
+DB_QUERY_SECONDS = REGISTRY.register(Histogram(
+    'chat_db_query_seconds', 'SQLite call time in the pool thread, commit included', ('kind', 'op'), DB_BUCKETS
+))
+DB_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'chat_db_queue_wait_seconds', 'Time a SQLite call waited for a free pool thread', ('kind',), DB_BUCKETS
+))
+EVENT_LOOP_LAG_SECONDS = REGISTRY.register(Histogram(
+    'chat_event_loop_lag_seconds', 'Event loop scheduling delay', (), LAG_BUCKETS
+))
+
+
+async def measure_event_loop_lag(interval=LAG_INTERVAL):
+    # Насколько позже запланированного просыпается задача - время, когда цикл был занят
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - interval))
+
+
+def timed(func, args):
+    # Выполняется в потоке пула: время самого запроса без ожидания в очереди
+    start = time.perf_counter()
+    result = func(*args)
+    return result, start, time.perf_counter()
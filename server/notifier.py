@@ -0,0 +1,76 @@
+import asyncio
+import socket
+from collections import defaultdict
+from pathlib import Path
+
+
+class MessageNotifier:
+    """Будит long-poll запросы получателя при появлении новых сообщений"""
+
+    def __init__(self):
+        self._waiters = defaultdict(set)
+
+    def subscribe(self, recipient_id):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[recipient_id].add(waiter)
+        return waiter
+
+    def unsubscribe(self, recipient_id, waiter):
+        waiters = self._waiters.get(recipient_id)
+        if waiters is None:
+            return
+        waiters.discard(waiter)
+        if not waiters:
+            del self._waiters[recipient_id]
+
+    def notify(self, recipient_id):
+        for waiter in self._waiters.pop(recipient_id, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class ClusterNotifier(MessageNotifier):
+    """Будит long-poll запросы и в остальных воркерах сервера через Unix datagram-сокеты"""
+
+    def __init__(self, socket_dir, worker, workers):
+        # Каждый воркер слушает свой сокет в общем каталоге и пересылает id получателя всем остальным
+        super().__init__()
+        self.socket_dir = Path(socket_dir)
+        self.path = self.socket_dir / f'worker-{worker}.sock'
+        self._peers = [str(self.socket_dir / f'worker-{i}.sock') for i in range(workers) if i != worker]
+        self._sock = None
+
+    async def start(self):
+        self.path.unlink(missing_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(str(self.path))
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._receive)
+
+    async def close(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        self.path.unlink(missing_ok=True)
+
+    def _receive(self):
+        while True:
+            try:
+                recipient_id = self._sock.recv(64)
+            except (BlockingIOError, InterruptedError):
+                return
+            super().notify(recipient_id)
+
+    def notify(self, recipient_id):
+        super().notify(recipient_id)
+        if self._sock is None:
+            return
+        for peer in self._peers:
+            try:
+                self._sock.sendto(recipient_id, peer)
+            except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+                # Воркер ещё не запущен или его очередь переполнена: получатель
+                # всё равно заберёт сообщение по окончании своего long-poll
+                pass
@@ -0,0 +1,127 @@
+import argparse
+import sqlite3
+import sys
+from pathlib import Path
+
+from database import (
+    DATABASE_PATH, ShardCountMismatch, shard_path, shard_index, init_storage, init_users_schema,
+    init_messages_schema, read_shard_count, write_shard_count
+)
+
+# Перераспределение сообщений при смене --shards. Запускать при остановленном сервере.
+# Переносятся только неподтверждённые строки получателей, чей шард изменился; в новом
+# файле они получают id больше любого прежнего, чтобы курсор клиента их не пропустил.
+# Сообщения, уже полученные, но ещё не подтверждённые, клиент может получить повторно.
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    init_storage(conn)
+    init_messages_schema(conn)
+    return conn
+
+
+def max_sequence(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    return row[0] if row else 0
+
+
+def raise_sequence(conn, seq):
+    # Новые id в файле-получателе будут больше seq
+    with conn:
+        if conn.execute("SELECT 1 FROM sqlite_sequence WHERE name = 'messages'").fetchone():
+            conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'messages'", (seq,))
+        else:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (seq,))
+
+
+def move_recipient(source, target, recipient_id):
+    acked = source.execute('SELECT last_id FROM acks WHERE recipient_id = ?', (recipient_id,)).fetchone()
+    rows = source.execute('''
+        SELECT m.sender_id, m.encrypted_message, m.timestamp, m.trace, m.blob_id, b.data
+        FROM messages m
+        LEFT JOIN blobs b ON b.id = m.blob_id
+        WHERE m.recipient_id = ? AND m.id > ?
+        ORDER BY m.id ASC
+    ''', (recipient_id, acked[0] if acked else 0)).fetchall()
+
+    # Сначала коммит в новый файл, потом удаление из старого: при сбое между ними
+    # сообщения задублируются, но не потеряются
+    blob_ids = {}
+    with target:
+        for sender_id, encrypted_message, timestamp, trace, blob_id, data in rows:
+            if blob_id is not None and blob_id not in blob_ids:
+                blob_ids[blob_id] = target.execute('INSERT INTO blobs (data) VALUES (?)', (data,)).lastrowid
+            target.execute('''
+                INSERT INTO messages (sender_id, recipient_id, encrypted_message, timestamp, trace, blob_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (sender_id, recipient_id, encrypted_message, timestamp, trace, blob_ids.get(blob_id)))
+    with source:
+        source.execute('DELETE FROM messages WHERE recipient_id = ?', (recipient_id,))
+        source.execute('DELETE FROM acks WHERE recipient_id = ?', (recipient_id,))
+    return len(rows)
+
+
+def rebalance(path, old_shards, new_shards):
+    # Число шардов записано в основной базе: сервер с другим --shards не запустится
+    main = sqlite3.connect(path)
+    init_storage(main)
+    init_users_schema(main)
+    stored = read_shard_count(main)
+    if stored is not None and stored != old_shards:
+        main.close()
+        raise ShardCountMismatch(f'Сообщения в {path} разнесены на {stored} шард(ов), а не на {old_shards}')
+
+    sources = [shard_path(path, i, old_shards) for i in range(old_shards)]
+    targets = [shard_path(path, i, new_shards) for i in range(new_shards)]
+    connections = {p: connect(p) for p in dict.fromkeys(sources + targets)}
+
+    # id курсоров клиентов выданы старыми файлами: новые id должны быть больше любого из них
+    seq = max(max_sequence(connections[p]) for p in sources)
+    for p in targets:
+        raise_sequence(connections[p], seq)
+
+    moved = 0
+    for p in sources:
+        source = connections[p]
+        recipients = [row[0] for row in source.execute('SELECT DISTINCT recipient_id FROM messages')]
+        for recipient_id in recipients:
+            target = targets[shard_index(recipient_id, new_shards)]
+            if target != p:
+                moved += move_recipient(source, connections[target], recipient_id)
+        with source:
+            source.execute('''
+                DELETE FROM blobs
+                WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.blob_id = blobs.id)
+            ''')
+
+    for conn in connections.values():
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+    write_shard_count(main, new_shards)
+    main.close()
+    # Опустевшие файлы шардов, которых нет в новой схеме, удаляем (основную базу не трогаем)
+    for p in sources:
+        if p not in targets and p != Path(path):
+            for suffix in ('', '-wal', '-shm'):
+                Path(f'{p}{suffix}').unlink(missing_ok=True)
+    return moved
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Перераспределение сообщений между шардами')
+    parser.add_argument('--db', default=DATABASE_PATH, help='Путь к основному файлу SQLite')
+    parser.add_argument('--from', dest='old_shards', type=int, required=True,
+                        help='Текущее количество шардов (1 - сообщения в основной базе)')
+    parser.add_argument('--to', dest='new_shards', type=int, required=True,
+                        help='Новое количество шардов')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        moved = rebalance(Path(args.db), max(args.old_shards, 1), max(args.new_shards, 1))
+    except ShardCountMismatch as e:
+        sys.exit(str(e))
+    print(f'Перенесено сообщений: {moved}')
@@ -1,35 +1,231 @@
 import sys
 import os
 import asyncio
+import argparse
+import cProfile
+import json
+import math
+import shutil
+import signal
+import tempfile
+import time
 from aiohttp import web
-from cryptography.hazmat.primitives import serialization
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from database import Database
+from database import (
+    Database, ShardCountMismatch, DATABASE_PATH, READERS, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, USER_CACHE_SIZE, MAX_LOOKUP,
+    LIMIT, MAX_PAGE_SIZE, MESSAGE_TTL, SHARDS
+)
+from memory_storage import MemoryStorage, MEMORY_BUDGET, RING_SIZE
+from log_storage import LogStorage, LOG_DIR, SEGMENT_SIZE
 from auth import generate_key_pair
+from cache import LRUCache
+from notifier import MessageNotifier, ClusterNotifier
+from files import FileStore, FileTooLarge, FILES_DIR, MAX_FILE_SIZE
+from metrics import (
+    REGISTRY, Counter, Gauge, HTTP_REQUESTS, HTTP_REQUEST_SECONDS, HTTP_IN_FLIGHT,
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, measure_event_loop_lag
+)
+from limits import (
+    RateLimiter, Admission, SEND_RATE, SEND_BURST, POLL_RATE, POLL_BURST, REGISTER_RATE, REGISTER_BURST,
+    IP_RATE, IP_BURST, MAX_IN_FLIGHT, OVERLOAD_RETRY_AFTER
+)
 from shared.crypto_utils import deserialize_public_key
+from shared.protocols import (
+    MessageProtocol, BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, NDJSON_CONTENT_TYPE, MAX_BODY_SIZE, ack_signing_data
+)
+
+MAX_WAIT = 60  # Максимальное время удержания long-poll запроса, сек
+MAINTENANCE_INTERVAL = 60  # Период очистки доставленных сообщений, сек
+MAX_RECIPIENTS = 256  # Максимум получателей в одной рассылке
+MAX_TRACE_SIZE = 1024  # Максимальный размер трассировки сообщения в JSON, байт
+MAX_TRACE_ID = 64  # Максимальная длина id трассировки
+ACK_MAX_AGE = 300  # Допустимое расхождение времени подписанного подтверждения с часами сервера, сек
+PORT = 8080
+
+# Маршруты, на которые действуют лимиты по адресу клиента
+LIMITED_ROUTES = {
+    '/register', '/message', '/message/multi', '/messages', '/messages/stream', '/ack',
+    '/users/lookup', '/file', '/file/{file_id}'
+}
 
 routes = web.RouteTableDef()
-db = Database()
+db = None
+notifier = None
+file_store = None
+send_limiter = None
+poll_limiter = None
+register_limiter = None
+ip_limiter = None
+admission = None
 server_private_key, server_public_key = generate_key_pair()
+# Разобранные открытые ключи пользователей по PEM: подпись проверяется на каждое подтверждение
+public_keys = LRUCache(USER_CACHE_SIZE)
+
+REJECTED = REGISTRY.register(Counter(
+    'chat_rejected_requests_total', 'Requests rejected by rate limits or admission control', ('route', 'reason')
+))
+REGISTRY.register(Gauge(
+    'chat_admitted_requests', 'Requests counted against the in-flight limit', func=lambda: admission.active
+))
+REGISTRY.register(Counter(
+    'chat_evicted_messages_total', 'Undelivered messages dropped by storage memory limits',
+    func=lambda: db.evicted
+))
+REGISTRY.register(Counter(
+    'chat_user_cache_hits_total', 'User cache hits', func=lambda: db.user_cache.hits if db.user_cache else 0
+))
+REGISTRY.register(Counter(
+    'chat_user_cache_misses_total', 'User cache misses', func=lambda: db.user_cache.misses if db.user_cache else 0
+))
+
+
+def route_name(request):
+    # Метка - шаблон маршрута, а не путь: /file/{file_id} не плодит отдельные ряды
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = route_name(request)
+    start = time.perf_counter()
+    status = 500
+    HTTP_IN_FLIGHT.inc()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        HTTP_REQUESTS.inc(request.method, route, status)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route)
+
+
+def check_rate(request, limiter, key, reason):
+    retry_after = limiter.take(key)
+    if retry_after:
+        REJECTED.inc(route_name(request), reason)
+        raise web.HTTPTooManyRequests(
+            text='Rate limit exceeded', headers={'Retry-After': str(math.ceil(retry_after))}
+        )
+
+
+def check_user_rate(request, limiter, user_id):
+    # id пользователя берётся из запроса без проверки, поэтому ведро - на пару (пользователь, адрес):
+    # запросы от чужого имени расходуют лимит того, кто их шлёт, а не пользователя
+    check_rate(request, limiter, (user_id, request.remote), 'user_rate')
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    # Лишние запросы отклоняются сразу, до разбора тела и обращения к базе.
+    # /metrics пропускаем всегда, чтобы перегрузку было видно
+    route = route_name(request)
+    if route == '/metrics':
+        return await handler(request)
+    if route in LIMITED_ROUTES:
+        check_rate(request, ip_limiter, request.remote, 'ip_rate')
+        if route == '/register':
+            check_rate(request, register_limiter, request.remote, 'register_rate')
+    if not admission.try_enter():
+        REJECTED.inc(route, 'overload')
+        raise web.HTTPServiceUnavailable(
+            text='Server overloaded', headers={'Retry-After': str(OVERLOAD_RETRY_AFTER)}
+        )
+    try:
+        return await handler(request)
+    finally:
+        admission.leave()
+
+
+def is_binary(request):
+    # Всё, что прислано не в бинарном формате, считаем JSON (старые клиенты шлют octet-stream)
+    return request.content_type == BINARY_CONTENT_TYPE
+
+
+def accepts_binary(request):
+    return BINARY_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def storage_headers():
+    # По epoch клиент узнаёт, что хранилище сменилось и его курсор больше ничего не значит
+    return {'X-Storage-Epoch': db.epoch} if db.epoch is not None else {}
+
+
+def page_size(request, name):
+    return max(1, min(int(request.query.get(name, LIMIT)), MAX_PAGE_SIZE))
+
+
+def valid_trace(trace):
+    # Трассировка уходит клиенту получателя как есть: id - короткая строка, этапы - только числа
+    if not isinstance(trace, dict) or not isinstance(trace.get('stages'), dict):
+        return False
+    if not isinstance(trace.get('id'), str) or not 0 < len(trace['id']) <= MAX_TRACE_ID:
+        return False
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in trace['stages'].values()):
+        return False
+    return len(json.dumps(trace)) <= MAX_TRACE_SIZE
+
+
+def stamp_delivered(rows):
+    # Момент выдачи клиенту дописывается к трассировке на лету, в базе он не хранится
+    if not any(len(row) > 5 and row[5] is not None for row in rows):
+        return rows
+    now = time.time()
+    stamped = []
+    for row in rows:
+        if row[5] is not None:
+            trace = json.loads(row[5])
+            trace['stages']['server_delivered'] = now
+            row = row[:5] + (json.dumps(trace),)
+        stamped.append(row)
+    return stamped
+
+
+def normalize_public_key(public_key):
+    # PEM открытого ключа ECDH на кривой клиентов или None, если прислан не такой ключ
+    try:
+        key = deserialize_public_key(public_key)
+    except (ValueError, UnsupportedAlgorithm):
+        return None
+    if not isinstance(key, ec.EllipticCurvePublicKey) or not isinstance(key.curve, ec.SECP384R1):
+        return None
+    return key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
 
 
 @routes.post('/register')
 async def register(request):
-    data = await request.json()
-    user_id = bytes.fromhex(data['user_id'])
-    public_key = data['public_key'].encode()  # Преобразуем строку в байты
-    username = data['username']
+    if is_binary(request):
+        user_id, public_key, username = MessageProtocol.decode_register_binary(await request.read())
+    else:
+        data = await request.json()
+        user_id = bytes.fromhex(data['user_id'])
+        public_key = data['public_key'].encode()  # Преобразуем строку в байты
+        username = data['username']
 
-    db.register_user(user_id, public_key, username)
+    # Ключ отдаётся собеседникам как текст PEM: в базу попадает только разобранный ключ
+    public_key = normalize_public_key(public_key)
+    if public_key is None:
+        return web.Response(status=400, text='Invalid public key')
+    await db.register_user(user_id, public_key, username)
     return web.Response(text='OK')
 
 
 @routes.get('/user_check')
 async def user_check(request):
     user_id = bytes.fromhex(request.query['user_id'])
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     if not user:
         return web.Response(status=404, text='User not found')
     return web.Response(text='User registered')
@@ -37,20 +233,72 @@ async def user_check(request):
 
 @routes.post('/message')
 async def post_message(request):
-    data = await request.json()
-    sender_id = bytes.fromhex(data['sender_id'])
-    recipient_id = bytes.fromhex(data['recipient_id'])
+    received = time.time()
+    trace = None
+    if is_binary(request):
+        sender_id, recipient_id, encrypted_message = MessageProtocol.decode_message_binary(await request.read())
+    else:
+        data = await request.json()
+        sender_id = bytes.fromhex(data['sender_id'])
+        recipient_id = bytes.fromhex(data['recipient_id'])
+        encrypted_message = bytes.fromhex(data['encrypted_message'])
+        # Трассировка есть только у сообщений, выбранных клиентом для замера
+        trace = data.get('trace')
+        if trace is not None and not valid_trace(trace):
+            return web.Response(status=400, text='Invalid trace')
+    check_user_rate(request, send_limiter, sender_id)
 
     # Проверка существования пользователей
-    if not db.get_user(sender_id):
+    if not await db.get_user(sender_id):
         return web.Response(text='Sender not found', status=404)
-    if not db.get_user(recipient_id):
+    if not await db.get_user(recipient_id):
         return web.Response(text='Recipient not found', status=404)
 
-    encrypted_message = bytes.fromhex(data['encrypted_message'])
+    # Настенное время: по нему клиент показывает сообщение и считается срок хранения
+    timestamp = time.time()
+    if trace is None:
+        await db.add_message(sender_id, recipient_id, encrypted_message, timestamp)
+        notifier.notify(recipient_id)
+        return web.Response(text='OK')
+
+    stages = {'server_received': received, 'server_insert': timestamp}
+    trace['stages'].update(stages)
+    await db.add_message(sender_id, recipient_id, encrypted_message, timestamp, json.dumps(trace))
+    notifier.notify(recipient_id)
+    # Момент коммита в базе не сохраняется - отдаём этапы сервера отправителю
+    stages['server_stored'] = time.time()
+    return web.Response(text='OK', headers={'X-Trace-Stages': json.dumps(stages)})
+
+
+@routes.post('/message/multi')
+async def post_message_multi(request):
+    # Либо у каждого получателя свой шифротекст, либо общий blob (encrypted_message)
+    # и у каждого получателя обёрнутый ключ к нему
+    if is_binary(request):
+        sender_id, recipients, blob = MessageProtocol.decode_multi_binary(await request.read())
+    else:
+        data = await request.json()
+        sender_id = bytes.fromhex(data['sender_id'])
+        blob = bytes.fromhex(data['encrypted_message']) if data.get('encrypted_message') else None
+        recipients = [
+            (bytes.fromhex(recipient['recipient_id']), bytes.fromhex(recipient['encrypted_message']))
+            for recipient in data['recipients']
+        ]
+    check_user_rate(request, send_limiter, sender_id)
+    if not recipients or len(recipients) > MAX_RECIPIENTS:
+        return web.Response(status=400, text=f'Expected 1..{MAX_RECIPIENTS} recipients')
 
-    timestamp = asyncio.get_event_loop().time()
-    db.add_message(sender_id, recipient_id, encrypted_message, timestamp)
+    # Проверка существования всех пользователей одним запросом
+    users = await db.get_users([sender_id] + [recipient_id for recipient_id, _ in recipients])
+    if sender_id not in users:
+        return web.Response(text='Sender not found', status=404)
+    missing = [recipient_id.hex() for recipient_id, _ in recipients if recipient_id not in users]
+    if missing:
+        return web.Response(text=f"Recipients not found: {', '.join(missing)}", status=404)
+
+    await db.add_messages_multi(sender_id, recipients, blob, time.time())
+    for recipient_id, _ in recipients:
+        notifier.notify(recipient_id)
     return web.Response(text='OK')
 
 
@@ -58,18 +306,142 @@ async def post_message(request):
 async def get_messages(request):
     recipient_id = bytes.fromhex(request.query['user_id'])
     last_id = int(request.query.get('last_id', 0))
+    check_user_rate(request, poll_limiter, recipient_id)
+    wait = min(float(request.query.get('wait', 0)), MAX_WAIT)
+    limit = page_size(request, 'limit')
+
+    # Подписываемся до запроса к БД, чтобы не пропустить сообщение между ними
+    waiter = notifier.subscribe(recipient_id) if wait > 0 else None
+    try:
+        messages = await db.get_messages(recipient_id, last_id, limit)
+        if not messages and waiter is not None:
+            try:
+                with admission.parked():
+                    await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                messages = await db.get_messages(recipient_id, last_id, limit)
+    finally:
+        if waiter is not None:
+            notifier.unsubscribe(recipient_id, waiter)
+
+    headers = storage_headers()
+    if waiter is not None:
+        headers['X-Long-Poll'] = str(wait)
+    messages = stamp_delivered(messages)
+    if accepts_binary(request):
+        return web.Response(
+            body=MessageProtocol.encode_rows_binary(messages),
+            content_type=BINARY_CONTENT_TYPE,
+            headers=headers
+        )
+    return web.Response(
+        body=MessageProtocol.encode_rows_json(messages),
+        content_type=JSON_CONTENT_TYPE,
+        headers=headers
+    )
+
+
+def verify_ack(public_key, signature, data):
+    # В пуле потоков: проверка ECDSA P-384 занимает порядка миллисекунды
+    public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+
+
+@routes.post('/ack')
+async def ack_messages(request):
+    # Клиент подтверждает, что обработал всё до last_id включительно - эти строки можно удалять.
+    # id пользователя вычисляется из имени, поэтому подтверждение подписывается ключом получателя:
+    # иначе кто угодно удалил бы чужие недоставленные сообщения. Повтор перехваченного запроса
+    # в пределах ACK_MAX_AGE ничего не меняет - курсор подтверждения только растёт
+    data = await request.json()
+    recipient_id = bytes.fromhex(data['user_id'])
+    last_id = int(data['last_id'])
+    if 'signature' not in data or 'timestamp' not in data:
+        return web.Response(status=401, text='Signed ack required')
+    timestamp = float(data['timestamp'])
+    if not 0 <= last_id < 2 ** 64 or not abs(time.time() - timestamp) <= ACK_MAX_AGE:
+        return web.Response(status=400, text='Invalid ack')
+
+    user = await db.get_user(recipient_id)
+    if not user:
+        return web.Response(status=404, text='User not found')
+    try:
+        public_key = public_keys.get(user[0])
+        if public_key is None:
+            public_key = deserialize_public_key(user[0])
+            public_keys.put(user[0], public_key)
+        await asyncio.get_running_loop().run_in_executor(
+            None, verify_ack, public_key, bytes.fromhex(data['signature']),
+            ack_signing_data(recipient_id, last_id, timestamp)
+        )
+    except (InvalidSignature, UnsupportedAlgorithm, ValueError, TypeError):
+        return web.Response(status=403, text='Invalid signature')
+    await db.ack(recipient_id, last_id)
+    return web.Response(text='OK')
+
+
+@routes.get('/messages/stream')
+async def stream_messages(request):
+    recipient_id = bytes.fromhex(request.query['user_id'])
+    last_id = int(request.query.get('last_id', 0))
+    check_user_rate(request, poll_limiter, recipient_id)
+    size = page_size(request, 'page_size')
+    binary = accepts_binary(request)
 
-    messages = db.get_messages(recipient_id, last_id)
-    formatted = [
-        {
-            'id': row[0],
-            'sender_id': row[1].hex(),
-            'encrypted_message': row[2].hex(),
-            'timestamp': row[3]
-        }
-        for row in messages
-    ]
-    return web.json_response(formatted)
+    resp = web.StreamResponse(headers=storage_headers())
+    resp.content_type = BINARY_CONTENT_TYPE if binary else NDJSON_CONTENT_TYPE
+    await resp.prepare(request)
+    # write() ждёт, пока клиент заберёт данные, поэтому медленный клиент
+    # притормаживает чтение из БД, а не раздувает буфер сервера
+    async for rows in db.iter_messages(recipient_id, last_id, size):
+        rows = stamp_delivered(rows)
+        if binary:
+            await resp.write(MessageProtocol.encode_rows_binary(rows))
+        else:
+            await resp.write(MessageProtocol.encode_rows_ndjson(rows))
+    await resp.write_eof()
+    return resp
+
+
+@routes.post('/file')
+async def upload_file(request):
+    # Тело - уже зашифрованный клиентом поток чанков, читаем и пишем его на диск по частям
+    sender_id = bytes.fromhex(request.query['sender_id'])
+    recipient_id = bytes.fromhex(request.query['recipient_id'])
+    users = await db.get_users([sender_id, recipient_id])
+    if sender_id not in users:
+        return web.Response(text='Sender not found', status=404)
+    if recipient_id not in users:
+        return web.Response(text='Recipient not found', status=404)
+
+    try:
+        file_id, size = await file_store.save(request.content)
+    except FileTooLarge as e:
+        return web.Response(status=413, text=str(e))
+    await db.add_file(file_id, sender_id, recipient_id, size, time.time())
+    return web.json_response({'file_id': file_id, 'size': size})
+
+
+@routes.get('/file/{file_id}')
+async def download_file(request):
+    file_id = request.match_info['file_id']
+    user_id = bytes.fromhex(request.query['user_id'])
+    info = await db.get_file(file_id)
+    # Файл доступен только отправителю и получателю
+    if not info or user_id not in (info[0], info[1]):
+        return web.Response(status=404, text='File not found')
+
+    # FileResponse отдаёт файл через sendfile, не читая его в память
+    return web.FileResponse(
+        file_store.file_path(file_id),
+        headers={'Content-Type': 'application/octet-stream', 'X-Sender-Id': info[0].hex()}
+    )
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': METRICS_CONTENT_TYPE})
 
 
 @routes.get('/public_key')
@@ -84,7 +456,7 @@ async def get_public_key(request):
 @routes.get('/user_public_key')
 async def get_user_public_key(request):
     user_id = bytes.fromhex(request.query['user_id'])
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     if not user:
         return web.Response(status=404, text='User not found')
 
@@ -108,7 +480,7 @@ async def get_user_public_key(request):
 @routes.get('/user_info')
 async def get_user_info(request):
     user_id = bytes.fromhex(request.query['user_id'])
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     if not user:
         return web.Response(status=404, text='User not found')
 
@@ -119,11 +491,228 @@ async def get_user_info(request):
     })
 
 
-app = web.Application()
-app.add_routes(routes)
+@routes.post('/users/lookup')
+async def users_lookup(request):
+    data = await request.json()
+    user_ids = list({bytes.fromhex(user_id) for user_id in data['user_ids']})
+    if len(user_ids) > MAX_LOOKUP:
+        return web.Response(status=400, text=f'Too many users (max {MAX_LOOKUP})')
+
+    users = await db.get_users(user_ids)
+    # Неизвестные id просто отсутствуют в ответе
+    found = {}
+    for user_id, (public_key, username) in users.items():
+        try:
+            found[user_id.hex()] = {'username': username, 'public_key': public_key.decode('utf-8')}
+        except UnicodeDecodeError:
+            # Ключ, записанный до проверки при регистрации, не ломает ответ для остальных
+            continue
+    return web.json_response(found)
+
+
+async def close_db(app):
+    db.close()
+
+
+async def start_notifier(app):
+    await notifier.start()
+
+
+async def close_notifier(app):
+    await notifier.close()
+
+
+async def event_loop_lag(app):
+    task = asyncio.create_task(measure_event_loop_lag())
+    yield
+    task.cancel()
+
+
+def profiling(path):
+    # cProfile потока цикла событий (обработчики, кодирование, уведомления), без потоков SQLite
+    async def run_profiler(app):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        yield
+        profiler.disable()
+        profiler.dump_stats(path)
+
+    return run_profiler
+
+
+def maintenance(message_ttl, interval):
+    # Фоновая очистка: доставленные и просроченные сообщения, чекпоинт WAL, возврат места
+    async def run_maintenance(app):
+        async def loop():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await db.compact(message_ttl)
+                    if message_ttl:
+                        await file_store.remove(await db.purge_files(message_ttl))
+                except Exception as e:
+                    print(f"Maintenance error: {e}")
+
+        task = asyncio.create_task(loop())
+        yield
+        task.cancel()
+
+    return run_maintenance
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Количество процессов-воркеров на одном порту (SO_REUSEPORT)')
+    parser.add_argument('--storage', choices=['sqlite', 'memory', 'log'], default='sqlite',
+                        help='Хранилище: SQLite, память без сохранения на диск или журнал сегментов')
+    parser.add_argument('--db', default=DATABASE_PATH, help='Путь к файлу SQLite')
+    parser.add_argument('--shards', type=int, default=SHARDS,
+                        help='На сколько файлов SQLite разнести сообщения по получателям '
+                             '(смена числа шардов - через rebalance.py)')
+    parser.add_argument('--db-readers', type=int, default=READERS,
+                        help='Количество соединений для чтения')
+    parser.add_argument('--batch-size', type=int, default=WRITE_BATCH_SIZE,
+                        help='Максимум сообщений в одной транзакции записи')
+    parser.add_argument('--batch-delay', type=float, default=WRITE_BATCH_DELAY,
+                        help='Сколько ждать пополнения пачки записи, сек')
+    parser.add_argument('--user-cache-size', type=int, default=USER_CACHE_SIZE,
+                        help='Сколько пользователей держать в кэше')
+    parser.add_argument('--memory-budget', type=int, default=MEMORY_BUDGET,
+                        help='--storage memory: общий объём сообщений в памяти, байт')
+    parser.add_argument('--ring-size', type=int, default=RING_SIZE,
+                        help='--storage memory: максимум недоставленных сообщений на получателя')
+    parser.add_argument('--log-dir', default=LOG_DIR, help='--storage log: каталог журнала')
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE,
+                        help='--storage log: размер сегмента журнала, байт')
+    parser.add_argument('--log-fsync', action='store_true',
+                        help='--storage log: fsync после каждой пачки записи')
+    parser.add_argument('--message-ttl', type=float, default=MESSAGE_TTL,
+                        help='Сколько хранить недоставленные сообщения, сек (0 - бессрочно)')
+    parser.add_argument('--maintenance-interval', type=float, default=MAINTENANCE_INTERVAL,
+                        help='Период фоновой очистки базы, сек')
+    parser.add_argument('--files-dir', default=FILES_DIR, help='Каталог для переданных файлов')
+    parser.add_argument('--max-file-size', type=int, default=MAX_FILE_SIZE,
+                        help='Максимальный размер файла, байт')
+    parser.add_argument('--profile', help='Записать cProfile сервера в этот файл при остановке '
+                                          '(с --workers - по файлу на воркер)')
+    # Лимиты считаются в каждом воркере отдельно; 0 - без ограничения
+    parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                        help='Отправок в секунду на пользователя с одного адреса')
+    parser.add_argument('--send-burst', type=int, default=SEND_BURST)
+    parser.add_argument('--poll-rate', type=float, default=POLL_RATE,
+                        help='Запросов /messages в секунду на пользователя с одного адреса')
+    parser.add_argument('--poll-burst', type=int, default=POLL_BURST)
+    parser.add_argument('--register-rate', type=float, default=REGISTER_RATE,
+                        help='Регистраций в секунду на адрес')
+    parser.add_argument('--register-burst', type=int, default=REGISTER_BURST)
+    parser.add_argument('--ip-rate', type=float, default=IP_RATE,
+                        help='Запросов к сообщениям, файлам, пользователям и регистрации в секунду на адрес')
+    parser.add_argument('--ip-burst', type=int, default=IP_BURST)
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help='Одновременно обрабатываемых запросов, сверх - 503')
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error('--batch-size должен быть не меньше 1')
+    if args.batch_delay < 0:
+        parser.error('--batch-delay не может быть отрицательным')
+    return args
+
+
+def open_storage(args):
+    if args.storage == 'memory':
+        return MemoryStorage(args.memory_budget, args.ring_size)
+    if args.storage == 'log':
+        return LogStorage(args.log_dir, args.db_readers, args.batch_size, args.batch_delay,
+                          args.segment_size, args.log_fsync)
+    return Database(args.db, args.db_readers, args.batch_size, args.batch_delay, args.user_cache_size, args.shards)
+
+
+def create_app(args, worker=0, socket_dir=None):
+    global db, notifier, file_store, send_limiter, poll_limiter, register_limiter, ip_limiter, admission
+    db = open_storage(args)
+    file_store = FileStore(args.files_dir, args.max_file_size)
+    send_limiter = RateLimiter(args.send_rate, args.send_burst)
+    poll_limiter = RateLimiter(args.poll_rate, args.poll_burst)
+    register_limiter = RateLimiter(args.register_rate, args.register_burst)
+    ip_limiter = RateLimiter(args.ip_rate, args.ip_burst)
+    admission = Admission(args.max_in_flight)
+
+    # Предел тела запроса задаёт и наибольший размер сообщения, на который рассчитывает клиент
+    app = web.Application(middlewares=[metrics_middleware, admission_middleware], client_max_size=MAX_BODY_SIZE)
+    app.add_routes(routes)
+    app.cleanup_ctx.append(event_loop_lag)
+    if args.profile:
+        app.cleanup_ctx.append(profiling(args.profile if args.workers <= 1 else f'{args.profile}.{worker}'))
+    if args.workers > 1:
+        # У каждого воркера свои счётчики, /metrics отдаёт метрики принявшего запрос
+        REGISTRY.const_labels['worker'] = str(worker)
+    if socket_dir is not None:
+        notifier = ClusterNotifier(socket_dir, worker, args.workers)
+        app.on_startup.append(start_notifier)
+        app.on_cleanup.append(close_notifier)
+    else:
+        notifier = MessageNotifier()
+    app.on_cleanup.append(close_db)
+    if worker == 0:
+        # Фоновая очистка общей базы нужна только в одном воркере
+        app.cleanup_ctx.append(maintenance(args.message_ttl, args.maintenance_interval))
+    return app
+
+
+def run_workers(args):
+    # Воркеры слушают один порт с SO_REUSEPORT (ядро распределяет соединения между ними)
+    # и работают с общей базой в режиме WAL
+    socket_dir = tempfile.mkdtemp(prefix='chat-server-')
+    # Схему создаём один раз до fork, чтобы воркеры не мигрировали базу одновременно
+    Database(args.db, 1, shards=args.shards).close()
+
+    children = []
+    for worker in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                web.run_app(create_app(args, worker, socket_dir), port=args.port,
+                            reuse_port=True, access_log=None)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except KeyboardInterrupt:
+                    # Ctrl+C получают все процессы группы, просто дожидаемся воркеров
+                    continue
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
 
 if __name__ == '__main__':
+    args = parse_args()
     try:
-        web.run_app(app, port=8080, access_log=None)
+        if args.workers > 1:
+            if not hasattr(os, 'fork'):
+                sys.exit('--workers требует fork и SO_REUSEPORT (Linux, macOS)')
+            if args.storage != 'sqlite':
+                # Память и журнал принадлежат одному процессу, общая база между воркерами - только SQLite
+                sys.exit('--workers поддерживается только с --storage sqlite')
+            run_workers(args)
+        else:
+            web.run_app(create_app(args), port=args.port, access_log=None)
+    except ShardCountMismatch as e:
+        sys.exit(str(e))
     except PermissionError as e:
         print(f"Выбранный порт занят. {e}")
@@ -1,33 +1,103 @@
 import json
-import hmac
 import os
+import struct
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.backends import default_backend
 
+# Бинарный формат: поля фиксированной длины и данные с префиксом длины (big-endian)
+BINARY_CONTENT_TYPE = 'application/x-chat-binary'
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
 
-def encrypt_message(key, message):
-    iv = os.urandom(16)
-    padder = padding.PKCS7(128).padder()
-    padded_data = padder.update(message.encode()) + padder.finalize()
+# Наибольшее тело запроса с сообщениями (client_max_size сервера): шифротекст получателя
+# и общий blob рассылки приходят в одном запросе, поэтому каждый из них не длиннее
+MAX_BODY_SIZE = 1024 ** 2
 
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+REGISTER_HEADER = struct.Struct('>16sH')  # user_id, длина username
+MESSAGE_HEADER = struct.Struct('>16s16s')  # sender_id, recipient_id
+# id, timestamp, sender_id, длина encrypted_message, длина общего blob (0 - его нет)
+ROW_HEADER = struct.Struct('>Qd16sII')
+MULTI_HEADER = struct.Struct('>16sIH')  # sender_id, длина общего blob, число получателей
+RECIPIENT_HEADER = struct.Struct('>16sI')  # recipient_id, длина encrypted_message
 
-    hmac_tag = hmac.new(key, ciphertext, 'sha256').digest()
-    return iv + ciphertext + hmac_tag
+# Конверт: версия (1 байт) + nonce (12 байт) + шифротекст с тегом AES-GCM (16 байт).
+# Байт версии входит в AAD, поэтому подменить его незаметно нельзя
+ENVELOPE_AESGCM = b'\x01'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+ENVELOPE_OVERHEAD = len(ENVELOPE_AESGCM) + NONCE_SIZE + TAG_SIZE
+
+# Файл передаётся потоком: версия + случайная соль файла, затем чанки
+# [длина, флаг последнего][nonce + шифротекст с тегом]. Номер чанка, флаг и соль входят в AAD,
+# поэтому переставить, подменить или отрезать чанки незаметно нельзя
+FILE_CHUNK_SIZE = 64 * 1024
+FILE_SALT_SIZE = 16
+FILE_HEADER_SIZE = len(ENVELOPE_AESGCM) + FILE_SALT_SIZE
+CHUNK_HEADER = struct.Struct('>IB')
+MAX_CHUNK_DATA = NONCE_SIZE + FILE_CHUNK_SIZE + TAG_SIZE  # Наибольшая длина чанка после его заголовка
+CHUNK_AAD = struct.Struct('>QB')
+FILE_NOTICE_PREFIX = '\x1efile '  # Сообщение-уведомление о файле: префикс + JSON с id, именем и размером
+ACK_SIGNED = struct.Struct('>16sQd')  # Подписываемое подтверждение: recipient_id, last_id, timestamp
+
+
+def encrypt_message(key, message):
+    if isinstance(message, str):
+        message = message.encode()
+    nonce = os.urandom(NONCE_SIZE)
+    return ENVELOPE_AESGCM + nonce + AESGCM(key).encrypt(nonce, message, ENVELOPE_AESGCM)
 
 
 def decrypt_message(key, encrypted_data):
+    if encrypted_data[:1] == ENVELOPE_AESGCM and len(encrypted_data) >= ENVELOPE_OVERHEAD:
+        nonce = encrypted_data[1:1 + NONCE_SIZE]
+        try:
+            return AESGCM(key).decrypt(nonce, encrypted_data[1 + NONCE_SIZE:], ENVELOPE_AESGCM)
+        except InvalidTag:
+            # Старое CBC-сообщение может случайно начинаться с байта версии
+            if not _is_legacy(encrypted_data):
+                raise ValueError("Message authentication failed")
+    return _decrypt_legacy(key, encrypted_data)
+
+
+def ack_signing_data(user_id, last_id, timestamp):
+    # Что подписывает клиент в /ack: сервер удаляет подтверждённое, поэтому чужой запрос не должен проходить
+    return b'ack' + ACK_SIGNED.pack(user_id, last_id, timestamp)
+
+
+def encrypt_file_header():
+    return ENVELOPE_AESGCM + os.urandom(FILE_SALT_SIZE)
+
+
+def encrypt_file_chunk(key, header, index, chunk, final):
+    nonce = os.urandom(NONCE_SIZE)
+    aad = header + CHUNK_AAD.pack(index, final)
+    data = nonce + AESGCM(key).encrypt(nonce, chunk, aad)
+    return CHUNK_HEADER.pack(len(data), final) + data
+
+
+def decrypt_file_chunk(key, header, index, data, final):
+    if header[:1] != ENVELOPE_AESGCM:
+        raise ValueError("Unknown file format")
+    aad = header + CHUNK_AAD.pack(index, final)
+    try:
+        return AESGCM(key).decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], aad)
+    except InvalidTag:
+        raise ValueError(f"Chunk {index} authentication failed")
+
+
+def _is_legacy(encrypted_data):
+    # Старый формат: IV (16 байт) + AES-CBC с PKCS7, длина кратна блоку
+    return len(encrypted_data) >= 32 and len(encrypted_data) % 16 == 0
+
+
+def _decrypt_legacy(key, encrypted_data):
+    if not _is_legacy(encrypted_data):
+        raise ValueError("Unknown message format")
     iv = encrypted_data[:16]
     ciphertext = encrypted_data[16:]
-    received_tag = encrypted_data[-32:]
-
-    # Проверка HMAC
-    expected_tag = hmac.new(key, ciphertext, 'sha256').digest()
-    if not hmac.compare_digest(received_tag, expected_tag):
-        raise ValueError("HMAC verification failed")
 
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
     decryptor = cipher.decryptor()
@@ -37,6 +107,21 @@ def decrypt_message(key, encrypted_data):
     return unpadder.update(padded_data) + unpadder.finalize()
 
 
+def _unpack(header, data, offset=0):
+    # Заголовок бинарного формата; обрезанный ввод - ValueError, как и испорченный JSON
+    try:
+        return header.unpack_from(data, offset)
+    except struct.error:
+        raise ValueError("Truncated binary message") from None
+
+
+def _take(data, offset, length):
+    # Поле с префиксом длины: данных должно хватить на всё поле
+    if offset + length > len(data):
+        raise ValueError("Truncated binary message")
+    return data[offset:offset + length]
+
+
 class MessageProtocol:
     @staticmethod
     def encode_register(user_id, public_key, username):
@@ -57,3 +142,124 @@ class MessageProtocol:
     @staticmethod
     def decode(data):
         return json.loads(data.decode())
+
+    @staticmethod
+    def encode_register_binary(user_id, public_key, username):
+        if isinstance(public_key, str):
+            public_key = public_key.encode()
+        username = username.encode()
+        return REGISTER_HEADER.pack(user_id, len(username)) + username + public_key
+
+    @staticmethod
+    def decode_register_binary(data):
+        user_id, username_len = _unpack(REGISTER_HEADER, data)
+        offset = REGISTER_HEADER.size
+        username = _take(data, offset, username_len).decode()
+        public_key = data[offset + username_len:]
+        return user_id, public_key, username
+
+    @staticmethod
+    def encode_message_binary(sender_id, recipient_id, encrypted_message):
+        return MESSAGE_HEADER.pack(sender_id, recipient_id) + encrypted_message
+
+    @staticmethod
+    def decode_message_binary(data):
+        sender_id, recipient_id = _unpack(MESSAGE_HEADER, data)
+        return sender_id, recipient_id, data[MESSAGE_HEADER.size:]
+
+    @staticmethod
+    def encode_multi_binary(sender_id, recipients, blob=None):
+        # recipients - пары (recipient_id, encrypted_message); при общем blob это обёрнутые ключи
+        blob = blob or b''
+        parts = [MULTI_HEADER.pack(sender_id, len(blob), len(recipients)), blob]
+        for recipient_id, encrypted_message in recipients:
+            parts.append(RECIPIENT_HEADER.pack(recipient_id, len(encrypted_message)))
+            parts.append(encrypted_message)
+        return b''.join(parts)
+
+    @staticmethod
+    def decode_multi_binary(data):
+        sender_id, blob_len, count = _unpack(MULTI_HEADER, data)
+        offset = MULTI_HEADER.size
+        blob = _take(data, offset, blob_len) or None
+        offset += blob_len
+        recipients = []
+        for _ in range(count):
+            recipient_id, length = _unpack(RECIPIENT_HEADER, data, offset)
+            offset += RECIPIENT_HEADER.size
+            recipients.append((recipient_id, _take(data, offset, length)))
+            offset += length
+        return sender_id, recipients, blob
+
+    @staticmethod
+    def encode_rows_binary(rows):
+        # rows - строки из Database.get_messages: (id, sender_id, encrypted_message, timestamp, blob[, trace]).
+        # Трассировка в бинарном формате не передаётся
+        parts = []
+        for row_id, sender_id, encrypted_message, timestamp, blob, *_ in rows:
+            blob = blob or b''
+            parts.append(ROW_HEADER.pack(row_id, timestamp, sender_id, len(encrypted_message), len(blob)))
+            parts.append(encrypted_message)
+            parts.append(blob)
+        return b''.join(parts)
+
+    @staticmethod
+    def decode_row_binary(header, payload):
+        row_id, timestamp, sender_id, length, blob_len = ROW_HEADER.unpack(header)
+        return {
+            'id': row_id,
+            'sender_id': sender_id,
+            'encrypted_message': bytes(payload[:length]),
+            'blob': bytes(payload[length:length + blob_len]) if blob_len else None,
+            'timestamp': timestamp
+        }
+
+    @staticmethod
+    def decode_rows_binary(data):
+        messages = []
+        offset = 0
+        view = memoryview(data)
+        while offset < len(data):
+            length, blob_len = _unpack(ROW_HEADER, data, offset)[3:]
+            start = offset + ROW_HEADER.size
+            end = start + length + blob_len
+            if end > len(data):
+                raise ValueError("Truncated binary message")
+            messages.append(MessageProtocol.decode_row_binary(view[offset:start], view[start:end]))
+            offset = end
+        return messages
+
+    @staticmethod
+    def row_to_json(row):
+        msg = {
+            'id': row[0],
+            'sender_id': row[1].hex(),
+            'encrypted_message': row[2].hex(),
+            'timestamp': row[3]
+        }
+        if row[4] is not None:
+            msg['blob'] = row[4].hex()
+        if len(row) > 5 and row[5] is not None:
+            msg['trace'] = json.loads(row[5])
+        return msg
+
+    @staticmethod
+    def row_from_json(msg):
+        return dict(
+            msg,
+            sender_id=bytes.fromhex(msg['sender_id']),
+            encrypted_message=bytes.fromhex(msg['encrypted_message']),
+            blob=bytes.fromhex(msg['blob']) if 'blob' in msg else None
+        )
+
+    @staticmethod
+    def encode_rows_json(rows):
+        return json.dumps([MessageProtocol.row_to_json(row) for row in rows]).encode()
+
+    @staticmethod
+    def decode_rows_json(data):
+        return [MessageProtocol.row_from_json(msg) for msg in json.loads(data)]
+
+    @staticmethod
+    def encode_rows_ndjson(rows):
+        return b''.join(json.dumps(MessageProtocol.row_to_json(row)).encode() + b'\n' for row in rows)
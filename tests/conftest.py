@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# Модули сервера и клиента импортируются так же, как их видят server.py и client.py,
+# общий код - как пакет shared
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'client'))
+sys.path.insert(0, str(ROOT / 'server'))
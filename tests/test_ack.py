@@ -0,0 +1,101 @@
+"""POST /ack: удаление подтверждённого только по подписи получателя"""
+import asyncio
+import sys
+import time
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import server
+from shared.protocols import ack_signing_data
+
+BOB, ALICE = b'B' * 16, b'A' * 16
+
+
+def pem(private_key):
+    return private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+
+
+def signed_ack(private_key, user_id, last_id, timestamp=None):
+    timestamp = time.time() if timestamp is None else timestamp
+    signature = private_key.sign(ack_signing_data(user_id, last_id, timestamp), ec.ECDSA(hashes.SHA256()))
+    return {'user_id': user_id.hex(), 'last_id': last_id, 'timestamp': timestamp, 'signature': signature.hex()}
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    # Сценарий получает клиента к серверу на SQLite во временном каталоге,
+    # ключи зарегистрированных bob и alice и id пяти сообщений от alice к bob
+    monkeypatch.setattr(sys, 'argv', ['server.py', '--db', str(tmp_path / 'chat.db'),
+                                      '--files-dir', str(tmp_path / 'files')])
+    args = server.parse_args()
+
+    def run_scenario(scenario):
+        async def main():
+            client = TestClient(TestServer(server.create_app(args)))
+            await client.start_server()
+            try:
+                keys = {}
+                for user_id, name in ((BOB, 'bob'), (ALICE, 'alice')):
+                    keys[name] = ec.generate_private_key(ec.SECP384R1())
+                    resp = await client.post('/register', json={
+                        'user_id': user_id.hex(), 'public_key': pem(keys[name]), 'username': name
+                    })
+                    assert resp.status == 200
+                ids = [await server.db.add_message(ALICE, BOB, b'm', time.time()) for _ in range(5)]
+                await scenario(client, keys, ids)
+            finally:
+                await client.close()
+
+        asyncio.run(main())
+
+    return run_scenario
+
+
+async def remaining():
+    await server.db.compact()
+    return [row[0] for row in await server.db.get_messages(BOB)]
+
+
+def test_unsigned_ack_rejected(run):
+    async def scenario(client, keys, ids):
+        resp = await client.post('/ack', json={'user_id': BOB.hex(), 'last_id': ids[-1]})
+        assert resp.status == 401
+        assert await remaining() == ids
+    run(scenario)
+
+
+def test_stale_ack_rejected(run):
+    async def scenario(client, keys, ids):
+        stale = time.time() - server.ACK_MAX_AGE - 10
+        resp = await client.post('/ack', json=signed_ack(keys['bob'], BOB, ids[-1], stale))
+        assert resp.status == 400
+        assert await remaining() == ids
+    run(scenario)
+
+
+def test_forged_ack_rejected(run):
+    async def scenario(client, keys, ids):
+        # Подпись чужим ключом, в том числе ключом другого зарегистрированного пользователя
+        for private_key in (keys['alice'], ec.generate_private_key(ec.SECP384R1())):
+            resp = await client.post('/ack', json=signed_ack(private_key, BOB, ids[-1]))
+            assert resp.status == 403
+        # Подпись под другим last_id
+        forged = dict(signed_ack(keys['bob'], BOB, ids[0]), last_id=ids[-1])
+        resp = await client.post('/ack', json=forged)
+        assert resp.status == 403
+        assert await remaining() == ids
+    run(scenario)
+
+
+def test_signed_ack_deletes_up_to_last_id(run):
+    async def scenario(client, keys, ids):
+        resp = await client.post('/ack', json=signed_ack(keys['bob'], BOB, ids[2]))
+        assert resp.status == 200
+        assert await remaining() == ids[3:]
+    run(scenario)
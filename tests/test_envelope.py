@@ -0,0 +1,153 @@
+"""Конверт сообщений AES-GCM с байтом версии, расшифровка сообщений старого формата AES-CBC
+и потоковое шифрование файлов по чанкам"""
+import asyncio
+import os
+
+import pytest
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from shared.protocols import (
+    encrypt_message, decrypt_message, encrypt_file_header, encrypt_file_chunk, decrypt_file_chunk,
+    ENVELOPE_AESGCM, ENVELOPE_OVERHEAD, FILE_CHUNK_SIZE, CHUNK_HEADER
+)
+from transfer import encrypted_chunks, download_file
+
+KEY = bytes(range(32))
+
+
+def encrypt_legacy(key, message, iv=None):
+    # Так шифровали сообщения версии до конверта: IV + AES-CBC с PKCS7
+    iv = iv or os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(message) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return iv + encryptor.update(padded) + encryptor.finalize()
+
+
+def test_roundtrip():
+    for message in ('привет', b'\x00binary\xff', b''):
+        encrypted = encrypt_message(KEY, message)
+        assert encrypted[:1] == ENVELOPE_AESGCM
+        expected = message.encode() if isinstance(message, str) else message
+        assert len(encrypted) == len(expected) + ENVELOPE_OVERHEAD
+        assert decrypt_message(KEY, encrypted) == expected
+    # Случайный nonce: одинаковый текст даёт разные шифротексты
+    assert encrypt_message(KEY, 'same') != encrypt_message(KEY, 'same')
+
+
+def test_tampering_detected():
+    encrypted = encrypt_message(KEY, 'secret message')
+    changed_version = b'\x02' + encrypted[1:]
+    flipped = encrypted[:-1] + bytes([encrypted[-1] ^ 1])
+    for data in (changed_version, flipped, encrypted[:-1]):
+        with pytest.raises(ValueError):
+            decrypt_message(KEY, data)
+    with pytest.raises(ValueError):
+        decrypt_message(os.urandom(32), encrypted)
+
+
+def test_legacy_cbc():
+    message = b'message from an old client'
+    assert decrypt_message(KEY, encrypt_legacy(KEY, message)) == message
+    # IV старого сообщения может начинаться с байта версии конверта
+    assert decrypt_message(KEY, encrypt_legacy(KEY, message, ENVELOPE_AESGCM + os.urandom(15))) == message
+
+
+def test_unknown_format():
+    for data in (b'', b'\x07short', os.urandom(33)):
+        with pytest.raises(ValueError):
+            decrypt_message(KEY, data)
+
+
+# Файлы: поток чанков, номер чанка, флаг последнего и заголовок файла входят в AAD
+
+SENDER = b'S' * 16
+
+
+def file_pieces(tmp_path, data):
+    # Заголовок файла и чанки с их заголовками - ровно то, что клиент отправляет на сервер
+    path = tmp_path / 'source.bin'
+    path.write_bytes(data)
+
+    async def collect():
+        return [piece async for piece in encrypted_chunks(path, KEY)]
+
+    return asyncio.run(collect())
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.status = 200
+        self.headers = {'X-Sender-Id': SENDER.hex()}
+        self.content = asyncio.StreamReader()
+        self.content.feed_data(body)
+        self.content.feed_eof()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeSession:
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, url):
+        return FakeResponse(self.body)
+
+
+def download(tmp_path, body):
+    async def sender_key(sender_id):
+        assert sender_id == SENDER
+        return KEY
+
+    async def main():
+        return await download_file(FakeSession(body), 'http://server', b'R' * 16, sender_key, 'id',
+                                   str(tmp_path / 'received.bin'))
+
+    return asyncio.run(main())
+
+
+def leftovers(tmp_path):
+    return sorted(p.name for p in tmp_path.iterdir() if p.name != 'source.bin')
+
+
+def test_file_roundtrip(tmp_path):
+    data = os.urandom(2 * FILE_CHUNK_SIZE + 100)
+    pieces = file_pieces(tmp_path, data)
+    assert len(pieces) == 4
+    path, size = download(tmp_path, b''.join(pieces))
+    assert size == len(data) and open(path, 'rb').read() == data
+    assert leftovers(tmp_path) == ['received.bin']
+
+
+def test_file_reordered_or_truncated(tmp_path):
+    header, *chunks = file_pieces(tmp_path, os.urandom(2 * FILE_CHUNK_SIZE + 100))
+    reordered = [header, chunks[1], chunks[0], chunks[2]]
+    with pytest.raises(ValueError):
+        download(tmp_path, b''.join(reordered))
+    # Поток оборван до чанка с флагом последнего
+    with pytest.raises(asyncio.IncompleteReadError):
+        download(tmp_path, b''.join([header] + chunks[:2]))
+    assert leftovers(tmp_path) == [], 'недокачанный файл удаляется'
+
+
+def test_file_oversized_chunk_rejected(tmp_path):
+    header = file_pieces(tmp_path, b'data')[0]
+    body = header + CHUNK_HEADER.pack(2 ** 32 - 1, 1)
+    with pytest.raises(ValueError, match='too large'):
+        download(tmp_path, body)
+    assert leftovers(tmp_path) == []
+
+
+def test_file_chunk_aad():
+    header = encrypt_file_header()
+    chunk = encrypt_file_chunk(KEY, header, 3, b'chunk', False)[CHUNK_HEADER.size:]
+    assert decrypt_file_chunk(KEY, header, 3, chunk, False) == b'chunk'
+    for index, final, file_header in ((2, False, header), (3, True, header), (3, False, encrypt_file_header())):
+        # Другой номер, подменённый флаг последнего или чанк из другого файла
+        with pytest.raises(ValueError):
+            decrypt_file_chunk(KEY, file_header, index, chunk, final)
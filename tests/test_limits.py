@@ -0,0 +1,69 @@
+"""Token bucket по ключу и ограничение числа одновременных запросов"""
+import pytest
+
+import limits
+from limits import RateLimiter, Admission
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Время ограничителя двигает сам тест
+    now = [1000.0]
+    monkeypatch.setattr(limits.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_burst_then_refill(clock):
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.take('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('a') == pytest.approx(0.5), 'пустое ведро: токен появится через 1 / rate'
+    clock[0] += 0.25
+    assert limiter.take('a') == pytest.approx(0.25), 'отказ не расходует накопленное'
+    clock[0] += 0.25
+    assert limiter.take('a') == 0
+    assert limiter.take('a') > 0
+
+
+def test_refill_capped_at_burst(clock):
+    limiter = RateLimiter(rate=10, burst=2)
+    limiter.take('a')
+    clock[0] += 3600
+    assert [limiter.take('a') for _ in range(2)] == [0, 0]
+    assert limiter.take('a') > 0, 'за простой копится не больше burst'
+
+
+def test_keys_independent(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    assert limiter.take(('alice', '10.0.0.1')) == 0
+    assert limiter.take(('alice', '10.0.0.1')) > 0
+    assert limiter.take(('alice', '10.0.0.2')) == 0
+    assert limiter.take(('bob', '10.0.0.1')) == 0
+
+
+def test_evicted_key_starts_full(clock):
+    limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+    limiter.take('a')
+    limiter.take('b')
+    limiter.take('c')
+    assert limiter.take('a') == 0
+
+
+def test_disabled_and_minimum_burst(clock):
+    unlimited = RateLimiter(rate=0, burst=0)
+    assert all(unlimited.take('a') == 0 for _ in range(1000))
+    limiter = RateLimiter(rate=1, burst=0)
+    assert limiter.take('a') == 0, 'burst меньше 1 пропускает хотя бы один запрос'
+    assert limiter.take('a') > 0
+
+
+def test_admission():
+    admission = Admission(limit=2)
+    assert admission.try_enter() and admission.try_enter()
+    assert not admission.try_enter()
+    with admission.parked():
+        # Ждущий long-poll не занимает место
+        assert admission.try_enter()
+        admission.leave()
+    admission.leave()
+    assert admission.try_enter()
+    assert Admission(limit=0).try_enter(), '0 - без ограничения'
@@ -0,0 +1,106 @@
+"""Бинарный формат запросов и ответов: то, что кодирует клиент, сервер читает без потерь, и наоборот"""
+import asyncio
+import json
+
+import pytest
+
+from client import read_stream
+from shared.protocols import MessageProtocol, ROW_HEADER, BINARY_CONTENT_TYPE, MAX_BODY_SIZE
+
+SENDER, RECIPIENT, OTHER = b'S' * 16, b'R' * 16, b'O' * 16
+PEM = b'-----BEGIN PUBLIC KEY-----\nMHY=\n-----END PUBLIC KEY-----\n'
+
+ROWS = [
+    (1, SENDER, b'hello', 1700000000.25, None),
+    (2, OTHER, b'wrapped-key', 1700000001.5, b'BLOB' * 100),
+    (2 ** 60, SENDER, b'', 1700000002.0, None, '{"id": "t", "stages": {}}'),
+]
+
+
+def test_register_roundtrip():
+    for public_key in (PEM, PEM.decode()):
+        data = MessageProtocol.encode_register_binary(SENDER, public_key, 'алиса')
+        assert MessageProtocol.decode_register_binary(data) == (SENDER, PEM, 'алиса')
+
+
+def test_message_roundtrip():
+    data = MessageProtocol.encode_message_binary(SENDER, RECIPIENT, b'\x01' + b'x' * 40)
+    assert MessageProtocol.decode_message_binary(data) == (SENDER, RECIPIENT, b'\x01' + b'x' * 40)
+
+
+def test_multi_roundtrip():
+    recipients = [(RECIPIENT, b'key-r'), (OTHER, b'key-o' * 10)]
+    data = MessageProtocol.encode_multi_binary(SENDER, recipients, b'BLOB' * 50)
+    assert MessageProtocol.decode_multi_binary(data) == (SENDER, recipients, b'BLOB' * 50)
+    # Без общего blob у каждого получателя свой шифротекст
+    assert MessageProtocol.decode_multi_binary(
+        MessageProtocol.encode_multi_binary(SENDER, recipients)
+    ) == (SENDER, recipients, None)
+
+
+def test_rows_roundtrip():
+    expected = [
+        {'id': row[0], 'sender_id': row[1], 'encrypted_message': row[2], 'timestamp': row[3], 'blob': row[4]}
+        for row in ROWS
+    ]
+    # Трассировка в бинарном формате не передаётся
+    assert MessageProtocol.decode_rows_binary(MessageProtocol.encode_rows_binary(ROWS)) == expected
+    assert MessageProtocol.decode_rows_binary(b'') == []
+
+    decoded = MessageProtocol.decode_rows_json(MessageProtocol.encode_rows_json(ROWS))
+    assert [{key: msg[key] for key in expected[0]} for msg in decoded] == expected
+    assert decoded[2]['trace'] == {'id': 't', 'stages': {}}
+    ndjson = MessageProtocol.encode_rows_ndjson(ROWS).splitlines()
+    assert [MessageProtocol.row_from_json(json.loads(line)) for line in ndjson] == decoded
+
+
+def test_row_header_prefix():
+    # Клиент читает поток по заголовку строки: он один и тот же в ответе и в потоке
+    data = MessageProtocol.encode_rows_binary(ROWS[:1])
+    header, payload = data[:ROW_HEADER.size], data[ROW_HEADER.size:]
+    assert MessageProtocol.decode_row_binary(header, payload)['encrypted_message'] == b'hello'
+
+
+class StreamResponse:
+    content_type = BINARY_CONTENT_TYPE
+
+    def __init__(self, body):
+        self.content = asyncio.StreamReader()
+        self.content.feed_data(body)
+        self.content.feed_eof()
+
+
+def read_all(body):
+    async def main():
+        return [batch async for batch in read_stream(StreamResponse(body))]
+
+    return asyncio.run(main())
+
+
+def test_stream_row_size_bounded():
+    encoded = MessageProtocol.encode_rows_binary(ROWS)
+    assert [row for batch in read_all(encoded) for row in batch] == MessageProtocol.decode_rows_binary(encoded)
+    # Длина из заголовка больше любого сообщения, принятого сервером: поток не буферизуется
+    for length, blob_len in ((2 ** 32 - 1, 0), (0, MAX_BODY_SIZE + 1)):
+        with pytest.raises(ValueError, match='too large'):
+            read_all(ROW_HEADER.pack(1, 1.0, SENDER, length, blob_len))
+
+
+@pytest.mark.parametrize('encoded, decode', [
+    (MessageProtocol.encode_register_binary(SENDER, PEM, 'alice'), MessageProtocol.decode_register_binary),
+    (MessageProtocol.encode_message_binary(SENDER, RECIPIENT, b'payload'), MessageProtocol.decode_message_binary),
+    (MessageProtocol.encode_multi_binary(SENDER, [(RECIPIENT, b'key-r'), (OTHER, b'key-o')], b'BLOB'),
+     MessageProtocol.decode_multi_binary),
+    (MessageProtocol.encode_rows_binary(ROWS), MessageProtocol.decode_rows_binary),
+])
+def test_truncated_input_rejected(encoded, decode):
+    decode(encoded)
+    # Обрыв внутри заголовка или поля с длиной - ошибка, а не укороченные данные
+    cuts = {1, 17, len(encoded) - 1}
+    if decode is MessageProtocol.decode_register_binary:
+        cuts = {1, 17, 20}  # Открытый ключ - остаток запроса, его длина не передаётся
+    if decode is MessageProtocol.decode_message_binary:
+        cuts = {1, 31}  # Шифротекст - остаток запроса
+    for cut in cuts:
+        with pytest.raises(ValueError):
+            decode(encoded[:cut])
@@ -0,0 +1,78 @@
+"""Перенос сообщений между шардами при смене --shards"""
+import asyncio
+import hashlib
+import time
+
+import pytest
+
+from database import Database, ShardCountMismatch, shard_index
+from rebalance import rebalance
+
+SENDER = hashlib.sha256(b'sender').digest()[:16]
+# id как у настоящих пользователей, чтобы получатели разошлись по разным шардам
+RECIPIENTS = [hashlib.sha256(f'user{n}'.encode()).digest()[:16] for n in range(12)]
+
+
+async def fill(path, shards):
+    # По 6 сообщений каждому получателю, первые 2 подтверждены. Возвращает все id по получателям
+    db = Database(str(path), shards=shards)
+    await db.register_user(SENDER, b'KEY', 'sender')
+    for n, recipient_id in enumerate(RECIPIENTS):
+        await db.register_user(recipient_id, b'KEY', f'user{n}')
+    sent = {}
+    for recipient_id in RECIPIENTS:
+        sent[recipient_id] = [await db.add_message(SENDER, recipient_id, f'm{i}'.encode(), time.time())
+                              for i in range(6)]
+        await db.ack(recipient_id, sent[recipient_id][1])
+    db.close()
+    return sent
+
+
+async def read_all(path, shards):
+    db = Database(str(path), shards=shards)
+    rows = {recipient_id: await db.get_messages(recipient_id, 0, 1000) for recipient_id in RECIPIENTS}
+    db.close()
+    return rows
+
+
+def moves(recipient_id, old_shards, new_shards):
+    # При одном шарде сообщения лежат в основной базе, поэтому переезжают все
+    if old_shards == 1 or new_shards == 1:
+        return True
+    return shard_index(recipient_id, old_shards) != shard_index(recipient_id, new_shards)
+
+
+@pytest.mark.parametrize('old_shards, new_shards', [(1, 3), (3, 2), (2, 1)])
+def test_rebalance(tmp_path, old_shards, new_shards):
+    path = tmp_path / 'chat.db'
+    sent = asyncio.run(fill(path, old_shards))
+    max_old_id = max(max(ids) for ids in sent.values())
+    moved = [r for r in RECIPIENTS if moves(r, old_shards, new_shards)]
+    assert moved, 'получатели разошлись по шардам'
+
+    assert rebalance(path, old_shards, new_shards) == 4 * len(moved)
+    rows = asyncio.run(read_all(path, new_shards))
+    for recipient_id in RECIPIENTS:
+        ids = [row[0] for row in rows[recipient_id]]
+        if recipient_id in moved:
+            # Подтверждённые строки не переносятся, неподтверждённые - все и в прежнем порядке,
+            # с id больше любого прежнего: курсор клиента мог дойти до любого из них
+            assert [row[2] for row in rows[recipient_id]] == [f'm{i}'.encode() for i in range(2, 6)]
+            assert ids == sorted(ids) and min(ids) > max_old_id
+        else:
+            assert ids == sent[recipient_id]
+
+    # Новое число шардов записано: запуск со старым отказывает
+    with pytest.raises(ShardCountMismatch):
+        Database(str(path), shards=old_shards)
+    for i in range(new_shards, old_shards):
+        assert not (tmp_path / f'chat.shard{i}.db').exists()
+
+
+def test_rebalance_checks_stored_count(tmp_path):
+    path = tmp_path / 'chat.db'
+    asyncio.run(fill(path, 2))
+    with pytest.raises(ShardCountMismatch):
+        rebalance(path, 3, 4)
+    with pytest.raises(ShardCountMismatch):
+        Database(str(path), shards=4)
@@ -0,0 +1,239 @@
+"""Общие требования ко всем хранилищам сервера - то, на что опирается server.py"""
+import asyncio
+import time
+
+import pytest
+
+from database import Database, Storage
+from memory_storage import MemoryStorage
+from log_storage import LogStorage
+
+SEGMENT_SIZE = 4096  # Маленькие сегменты, чтобы проверки задели ротацию и очистку журнала
+
+# Фабрики: (создать в каталоге, переживает ли перезапуск)
+BACKENDS = {
+    'sqlite': (lambda d: Database(str(d / 'chat.db')), True),
+    'memory': (lambda d: MemoryStorage(), False),
+    'log': (lambda d: LogStorage(d / 'log', segment_size=SEGMENT_SIZE), True),
+}
+
+
+def user(n):
+    return n.to_bytes(16, 'big')
+
+
+ALICE, BOB, CAROL = user(1), user(2), user(3)
+
+
+class Backend:
+    """Хранилище одного вида в своём каталоге; reopen - перезапуск сервера"""
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.make, self.durable = BACKENDS[name]
+        self.directory = directory
+        self.storage = None
+
+    def open(self):
+        self.storage = self.make(self.directory)
+        return self.storage
+
+    def reopen(self):
+        self.storage.close()
+        return self.open()
+
+    def close(self):
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+
+
+@pytest.fixture(params=list(BACKENDS))
+def backend(request, tmp_path):
+    backend = Backend(request.param, tmp_path)
+    yield backend
+    backend.close()
+
+
+async def with_users(backend):
+    storage = backend.open()
+    for user_id, name in ((ALICE, 'alice'), (BOB, 'bob'), (CAROL, 'carol')):
+        await storage.register_user(user_id, f'KEY-{name}'.encode(), name)
+    return storage
+
+
+def test_users(backend):
+    async def scenario():
+        storage = await with_users(backend)
+        await storage.register_user(ALICE, b'OTHER', 'mallory')
+        assert await storage.get_user(ALICE) == (b'KEY-alice', 'alice'), 'повторная регистрация не меняет пользователя'
+        assert await storage.get_user(user(99)) is None
+        assert set(await storage.get_users([ALICE, BOB, user(99)])) == {ALICE, BOB}
+    asyncio.run(scenario())
+
+
+def test_messages_in_order_with_paging(backend):
+    async def scenario():
+        storage = await with_users(backend)
+        now = time.time()
+        ids = [await storage.add_message(ALICE, BOB, f'm{i}'.encode() * 50, now, '{"stages": {}}' if i == 0 else None)
+               for i in range(20)]
+        assert ids == sorted(ids) and len(set(ids)) == len(ids)
+        rows = await storage.get_messages(BOB)
+        assert [row[0] for row in rows] == ids
+        assert rows[3][1:5] == (ALICE, b'm3' * 50, now, None)
+        assert rows[0][5] == '{"stages": {}}' and rows[1][5] is None, 'трассировка сохраняется'
+        assert [row[0] for row in await storage.get_messages(BOB, ids[4], 3)] == ids[5:8]
+        assert await storage.get_messages(CAROL) == []
+    asyncio.run(scenario())
+
+
+def test_concurrent_and_multi(backend):
+    async def scenario():
+        storage = await with_users(backend)
+        now = time.time()
+        first = await storage.add_message(ALICE, BOB, b'first', now)
+        # Параллельные отправки проходят групповой записью
+        more = await asyncio.gather(*(storage.add_message(CAROL, BOB, b'x' * 100, now) for _ in range(200)))
+        assert len(set(more)) == 200 and min(more) > first
+        multi = await storage.add_messages_multi(ALICE, [(BOB, b'wrap-b'), (CAROL, b'wrap-c')], b'BLOB' * 100, now)
+        assert len(multi) == 2 and min(multi) > max(more)
+        carol_rows = await storage.get_messages(CAROL)
+        assert [(row[0], row[2], row[4]) for row in carol_rows] == [(multi[1], b'wrap-c', b'BLOB' * 100)]
+
+        pages = [rows async for rows in storage.iter_messages(BOB, 0, 7)]
+        assert all(len(page) <= 7 for page in pages)
+        assert [row[0] for page in pages for row in page] == [first] + sorted(more) + [multi[0]]
+    asyncio.run(scenario())
+
+
+def test_compact_keeps_unacked(backend):
+    async def scenario():
+        storage = await with_users(backend)
+        now = time.time()
+        acked = [await storage.add_message(ALICE, BOB, b'y' * 200, now) for _ in range(30)]
+        pending = [await storage.add_message(CAROL, BOB, b'z' * 200, now) for _ in range(30)]
+        await storage.ack(BOB, acked[-1])
+        assert isinstance(await storage.compact(), int)
+        assert [row[0] for row in await storage.get_messages(BOB, acked[-1], 1000)] == pending
+    asyncio.run(scenario())
+
+
+def test_ack_beyond_newest_message(backend):
+    async def scenario():
+        # Подтверждение из будущего (устаревший курсор клиента) не удаляет новые сообщения
+        storage = await with_users(backend)
+        await storage.ack(BOB, 10 ** 15)
+        # Каждое сообщение больше сегмента журнала - предыдущие сегменты закрыты и подлежат очистке
+        ids = [await storage.add_message(ALICE, BOB, b'n' * SEGMENT_SIZE, time.time()) for _ in range(3)]
+        await storage.compact()
+        assert [row[0] for row in await storage.get_messages(BOB)] == ids
+    asyncio.run(scenario())
+
+
+def test_expired_messages_purged(backend):
+    async def scenario():
+        storage = await with_users(backend)
+        await storage.add_message(ALICE, BOB, b'old' * 2000, time.time() - 7200)
+        fresh = await storage.add_message(ALICE, CAROL, b'fresh', time.time())
+        await storage.compact(message_ttl=3600)
+        assert await storage.get_messages(BOB) == []
+        assert [row[0] for row in await storage.get_messages(CAROL)] == [fresh]
+    asyncio.run(scenario())
+
+
+def test_files(backend):
+    async def scenario():
+        storage = await with_users(backend)
+        now = time.time()
+        await storage.add_file('old', ALICE, BOB, 10, now - 100)
+        await storage.add_file('new', ALICE, BOB, 20, now)
+        assert await storage.get_file('new') == (ALICE, BOB, 20, now)
+        assert await storage.purge_files(50) == ['old']
+        assert await storage.get_file('old') is None
+    asyncio.run(scenario())
+
+
+def test_survives_restart(backend):
+    if not backend.durable:
+        pytest.skip('хранилище в памяти не переживает перезапуск')
+
+    async def scenario():
+        storage = await with_users(backend)
+        now = time.time()
+        ids = [await storage.add_message(ALICE, BOB, b'm' * 300, now) for _ in range(30)]
+        await storage.ack(BOB, ids[9])
+        await storage.compact()
+        await storage.add_file('new', ALICE, BOB, 20, now)
+        storage = backend.reopen()
+        assert await storage.get_user(BOB) == (b'KEY-bob', 'bob')
+        assert [row[0] for row in await storage.get_messages(BOB, ids[9], 1000)] == ids[10:]
+        assert await storage.get_file('new') == (ALICE, BOB, 20, now)
+    asyncio.run(scenario())
+
+
+def test_ids_never_reused(backend):
+    async def scenario():
+        # Курсоры клиентов хранятся у них: после очистки и перезапуска id не начинаются заново
+        storage = await with_users(backend)
+        now = time.time()
+        last = [await storage.add_message(ALICE, BOB, b'm' * 300, now) for _ in range(30)][-1]
+        await storage.ack(BOB, last)
+        await storage.compact()
+        storage = backend.reopen()
+        if not backend.durable:
+            await storage.register_user(ALICE, b'KEY-alice', 'alice')
+            await storage.register_user(BOB, b'KEY-bob', 'bob')
+        assert await storage.add_message(ALICE, BOB, b'after', now) > last
+    asyncio.run(scenario())
+
+
+def test_epoch(backend, tmp_path):
+    # Клиент сбрасывает курсор при смене epoch: он постоянен, пока живут id хранилища
+    epoch = backend.open().epoch
+    assert isinstance(epoch, str) and epoch
+    assert (backend.reopen().epoch == epoch) == backend.durable
+    other = Backend(backend.name, tmp_path / 'other')
+    (tmp_path / 'other').mkdir()
+    assert other.open().epoch != epoch, 'новое хранилище - новые id'
+    other.close()
+
+
+def test_memory_eviction_counted():
+    async def scenario():
+        # Вытеснение - потеря недоставленных сообщений, поэтому оно считается (chat_evicted_messages_total)
+        storage = MemoryStorage(budget=10 ** 9, ring_size=5)
+        ids = [await storage.add_message(ALICE, BOB, b'r', time.time()) for _ in range(8)]
+        assert [row[0] for row in await storage.get_messages(BOB)] == ids[3:]
+        assert storage.evicted == 3
+        storage = MemoryStorage(budget=5000)
+        ids = [await storage.add_message(ALICE, BOB, b'b' * 1000, time.time()) for _ in range(8)]
+        kept = [row[0] for row in await storage.get_messages(BOB)]
+        assert kept == ids[-len(kept):] and storage.evicted == len(ids) - len(kept) > 0
+    asyncio.run(scenario())
+
+
+def test_log_meta_torn_tail(tmp_path):
+    async def scenario():
+        storage = LogStorage(tmp_path)
+        await storage.register_user(ALICE, b'KEY-alice', 'alice')
+        storage.close()
+        with open(tmp_path / 'meta.log', 'a') as f:
+            f.write('{"type": "user", "id"')  # Запись, оборванная сбоем
+        storage = LogStorage(tmp_path)
+        await storage.register_user(BOB, b'KEY-bob', 'bob')
+        storage.close()
+        storage = LogStorage(tmp_path)
+        assert await storage.get_user(ALICE) == (b'KEY-alice', 'alice')
+        assert await storage.get_user(BOB) == (b'KEY-bob', 'bob'), 'записи после сбоя не теряются'
+        storage.close()
+    asyncio.run(scenario())
+
+
+def test_incomplete_backend_rejected():
+    class Incomplete(Storage):
+        async def get_user(self, user_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,46 @@
+"""Локальная история клиента и курсор, привязанный к epoch хранилища сервера"""
+from client import storage_changed
+from store import MessageStore
+
+
+def message(row_id, text):
+    return {'id': row_id, 'sender_id': b'S' * 16, 'sender_name': 'alice', 'text': text,
+            'encrypted_message': None, 'timestamp': 1700000000.0 + row_id}
+
+
+class Response:
+    def __init__(self, epoch):
+        self.headers = {'X-Storage-Epoch': epoch} if epoch is not None else {}
+
+
+def test_cursor_survives_reopen(tmp_path):
+    store = MessageStore(str(tmp_path / 'bob'))
+    assert (store.last_id(), store.epoch()) == (0, None)
+    store.set_epoch('first')
+    store.save_messages([message(1, 'one'), message(2, 'two')], 2)
+    store.close()
+    store = MessageStore(str(tmp_path / 'bob'))
+    assert (store.last_id(), store.epoch()) == (2, 'first')
+    assert [msg['text'] for msg in store.recent()] == ['one', 'two']
+    store.close()
+
+
+def test_epoch_change_resets_cursor(tmp_path):
+    store = MessageStore(str(tmp_path / 'bob'))
+    # Первый epoch принимается без сброса: курсор выдан этим же хранилищем
+    store.save_messages([message(7, 'before')], 7)
+    assert not storage_changed(Response('first'), store)
+    assert (store.last_id(), store.epoch()) == (7, 'first')
+    assert not storage_changed(Response('first'), store)
+    assert not storage_changed(Response(None), store), 'старый сервер epoch не сообщает'
+    store.save_messages([message(8, 'eight'), message(9, 'nine')], 9)
+
+    assert storage_changed(Response('second'), store)
+    assert (store.last_id(), store.epoch()) == (0, 'second')
+    # Новое хранилище выдаёт id заново: совпавшие с прежними не теряются как повторы
+    store.save_messages([message(8, 'new eight'), message(9, 'new nine')], 9)
+    assert [msg['text'] for msg in store.recent()] == ['before', 'eight', 'nine', 'new eight', 'new nine']
+    # Повтор той же страницы (ответ потерялся до подтверждения) историю не дублирует
+    store.save_messages([message(9, 'new nine')], 9)
+    assert len(store.recent()) == 5
+    store.close()